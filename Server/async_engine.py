@@ -0,0 +1,263 @@
+"""
+asyncio client of the engine, so one event loop can drive many engines.
+Every command has a deadline, replies are framed by the protocol, a
+cancelled search is stopped with `stop`, and a crashed engine is restarted
+on its next command.
+Usage: python async_engine.py [ENGINES]
+"""
+import asyncio
+import os
+import sys
+import time
+from typing import Callable, List
+
+from engine_wrapper import ENGINE_FILE, EngineBusy, EngineError, EngineTimeout
+
+
+# the last line of the reply to each command
+def is_ready(line: str) -> bool:
+    return line == 'readyok'
+
+
+def is_any(line: str) -> bool:
+    return True
+
+
+def is_go_end(line: str) -> bool:
+    return line in ('endinfo', 'end of game')
+
+
+def is_board_end(line: str) -> bool:
+    # the board is followed by a line of the column numbers
+    return line.split() == list('0123456')
+
+
+class AsyncEngine:
+    """
+    One engine process, running one command at a time
+    """
+
+    def __init__(self, path: str, executable, timeout: float = 30,
+                 stop_grace: float = 2) -> None:
+        """
+        Parameters
+        ----------
+        path, executable:
+            As per `EngineInstance`
+        timeout: `float`
+            Defaults to 30. The deadline of a command, in seconds
+        stop_grace: `float`
+            Defaults to 2. Seconds a stopped search may take to answer,
+            after which the engine is restarted
+        """
+        self.path = path
+        self.executable = executable
+        self.timeout = timeout
+        self.stop_grace = stop_grace
+        self.proc = None
+        self.lock = asyncio.Lock()
+        # the end of the reply to a cancelled command, which must be read
+        # before the next command
+        self.pending = None
+        self.restarts = 0
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self) -> None:
+        """
+        Raises
+        ------
+        `EngineError`
+            The engine did not start
+        """
+        self.proc = await asyncio.create_subprocess_exec(
+            os.path.abspath(os.path.join(self.path, self.executable)),
+            cwd=self.path,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE)
+        self.pending = None
+        self._write('isready')
+        await self._read_until(is_ready, self._deadline(self.timeout))
+
+    async def close(self) -> None:
+        if self.alive():
+            self.proc.kill()
+            await self.proc.wait()
+        self.proc = None
+
+    def _deadline(self, timeout: float) -> float:
+        # only called from the engine's coroutines
+        return asyncio.get_running_loop().time() + timeout
+
+    def _write(self, command: str) -> None:
+        self.proc.stdin.write((command + '\n').encode())
+
+    async def _read_until(self, is_last: Callable[[str], bool],
+                          deadline: float) -> List[str]:
+        lines = []
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            try:
+                raw = await asyncio.wait_for(self.proc.stdout.readline(),
+                                             max(0, remaining))
+            except asyncio.TimeoutError:
+                raise EngineTimeout('Engine missed its deadline')
+            if not raw:
+                raise EngineError('Engine process exited')
+            line = raw.decode().strip()
+            lines.append(line)
+            if is_last(line):
+                return lines
+
+    async def _prepare(self) -> None:
+        # restart a dead engine, and read off the reply of a stopped search
+        if self.pending is not None and self.alive():
+            try:
+                await self._read_until(self.pending,
+                                       self._deadline(self.stop_grace))
+            except EngineError:
+                self.restarts += 1
+                await self.close()
+            self.pending = None
+        if not self.alive():
+            if self.proc is not None:
+                self.restarts += 1
+            await self.close()
+            await self.start()
+
+    async def command(self, command: str, is_last: Callable[[str], bool],
+                      timeout: float = None) -> List[str]:
+        """
+        Parameters
+        ----------
+        command: `str`
+            One or more newline separated commands
+        is_last: `Callable[[str], bool]`
+            True for the last line of the reply
+        timeout: `float`
+            Defaults to None. The deadline in seconds, None for the default
+        Returns
+        -------
+        lines: `List[str]`
+            The reply
+        Raises
+        ------
+        `EngineTimeout`
+            The deadline passed, the command was stopped
+        `EngineError`
+            The engine exited, it is restarted on the next command
+        """
+        async with self.lock:
+            await self._prepare()
+            self._write(command)
+            try:
+                await self.proc.stdin.drain()
+                return await self._read_until(
+                    is_last, self._deadline(timeout or self.timeout))
+            except (asyncio.CancelledError, EngineTimeout):
+                # searches end early on stop, others end anyway. Either
+                # way the reply is read off before the next command
+                if self.alive():
+                    self._write('stop')
+                    self.pending = is_last
+                raise
+            except (EngineError, ConnectionError):
+                self.restarts += 1
+                await self.close()
+                raise EngineError('Engine process exited')
+
+    async def geteval(self, posstr: str, nodes: int = 1000,
+                      timeout: float = None) -> str:
+        lines = await self.command(
+            f'position set {posstr}\ngetbest n {nodes}', is_any, timeout)
+        return lines[0]
+
+    async def go(self, posstr: str, nodes: int = 1000,
+                 timeout: float = None) -> List[str]:
+        return await self.command(f'position set {posstr}\ngo n {nodes}',
+                                  is_go_end, timeout)
+
+    async def show(self) -> List[str]:
+        return await self.command('d', is_board_end)
+
+
+class AsyncEnginePool:
+    """
+    Several `AsyncEngine`, each lent to one caller at a time
+    """
+
+    def __init__(self, path: str, executable, size: int,
+                 max_waiting: int = 32, **kwargs) -> None:
+        """
+        Parameters
+        ----------
+        path, executable:
+            As per `EngineInstance`
+        size: `int`
+            The number of engines
+        max_waiting: `int`
+            Defaults to 32. Callers waiting beyond this get `EngineBusy`
+        kwargs:
+            As per `AsyncEngine`
+        """
+        self.engines = [AsyncEngine(path, executable, **kwargs)
+                        for _ in range(size)]
+        self.max_waiting = max_waiting
+        self.idle = None
+        self.waiting = 0
+
+    async def start(self) -> 'AsyncEnginePool':
+        self.idle = asyncio.Queue()
+        await asyncio.gather(*(eng.start() for eng in self.engines))
+        for eng in self.engines:
+            self.idle.put_nowait(eng)
+        return self
+
+    async def close(self) -> None:
+        await asyncio.gather(*(eng.close() for eng in self.engines))
+
+    async def _run(self, method: str, *args, **kwargs):
+        if self.waiting >= self.max_waiting:
+            raise EngineBusy('Too many requests waiting')
+        self.waiting += 1
+        try:
+            eng = await self.idle.get()
+        finally:
+            self.waiting -= 1
+        try:
+            return await getattr(eng, method)(*args, **kwargs)
+        finally:
+            self.idle.put_nowait(eng)
+
+    async def geteval(self, posstr: str, nodes: int = 1000,
+                      timeout: float = None) -> str:
+        return await self._run('geteval', posstr, nodes, timeout)
+
+    async def go(self, posstr: str, nodes: int = 1000,
+                 timeout: float = None) -> List[str]:
+        return await self._run('go', posstr, nodes, timeout)
+
+    def stats(self) -> dict:
+        return {'engines': len(self.engines),
+                'idle': self.idle.qsize() if self.idle else 0,
+                'waiting': self.waiting,
+                'restarts': sum(eng.restarts for eng in self.engines)}
+
+
+async def main(size: int) -> None:
+    pool = await AsyncEnginePool(*os.path.split(ENGINE_FILE), size).start()
+    positions = ['7/7/7/7/7/7', '7/7/7/7/7/3x3', '7/7/7/7/3o3/3x3',
+                 '7/7/7/7/3o3/3xx2', '7/7/7/7/3o3/2oxx2',
+                 '7/7/7/3x3/3o3/2oxx2']
+    start = time.time()
+    answers = await asyncio.gather(*(pool.geteval(p, 1000) for p in positions))
+    for posstr, answer in zip(positions, answers):
+        print(f'{posstr}: {answer}')
+    print(f'{len(positions)} positions on {size} engines in '
+          f'{time.time() - start:.2f}s')
+    await pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2))
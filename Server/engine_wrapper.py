@@ -1,52 +1,349 @@
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from subprocess import Popen, PIPE
+from typing import Iterator, List, Sequence, Tuple
+
+
+# the engine executable, relative to the Server directory
+ENGINE_FILE = os.environ.get('C4UCT_ENGINE', os.path.join(
+    'Engine', 'C4UCT.exe' if sys.platform == 'win32' else 'C4UCT'))
+
+
+class EngineError(Exception):
+    """
+    The engine process exited or stopped responding
+    """
+
+
+class EngineTimeout(EngineError):
+    """
+    The engine did not answer in time
+    """
+
+
+class EngineBusy(Exception):
+    """
+    No engine became free in time, or too many requests are waiting
+    """
+
+
+def parse_info(line: str) -> dict:
+    """
+    Parameters
+    ----------
+    line: `str`
+        An `info nodes N q Q pv M M ...` line of the engine's `go` output
+    Returns
+    -------
+    info: `dict`
+        The nodes searched, Q of the first pv move and the pv
+    """
+    words = line.split()
+    pv = words.index('pv')
+    return {'nodes': int(words[words.index('nodes') + 1]),
+            'q': float(words[words.index('q') + 1]),
+            'pv': [int(m) for m in words[pv + 1:]]}
 
 
 class EngineInstance:
 
-    def __init__(self, path: str, executable) -> None:
+    def __init__(self, path: str, executable, timeout: float = 30) -> None:
+        """
+        Parameters
+        ----------
+        path: `str`
+            The directory to run the engine in
+        executable:
+            The engine executable in `path`
+        timeout: `float`
+            Defaults to 30. Seconds to wait for the engine to be ready
+        Raises
+        ------
+        `EngineError`
+            The engine did not start
+        """
+        # absolute, as a relative executable would be looked up from cwd on
+        # some platforms
         self.engine = Popen(
-            f'./{path}/{executable}',
-            cwd=f'./{path}',
+            os.path.abspath(os.path.join(path, executable)),
+            cwd=path,
             universal_newlines=True,
             stdin=PIPE,
             stdout=PIPE
         )
+        # output lines are read on a thread, so reads can time out
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
         # await engine ready
         self.send('isready')
         while True:
-            text = self.engine.stdout.readline()
-            if not text:
-                continue
+            text = self.read_line(timeout)
             if 'readyok' in text:
                 print('Instance ready!')
                 break
 
     def __del__(self) -> None:
+        self.kill()
+
+    def _read(self) -> None:
+        for line in self.engine.stdout:
+            self.lines.put(line.rstrip())
+        self.lines.put(None)  # end of output
+
+    def kill(self) -> None:
         self.engine.kill()
 
+    def alive(self) -> bool:
+        return self.engine.poll() is None
+
+    def read_line(self, timeout: float = None) -> str:
+        """
+        Parameters
+        ----------
+        timeout: `float`
+            Defaults to None. Seconds to wait for the line, None to wait
+            forever
+        Returns
+        -------
+        line: `str`
+            The next line of engine output
+        Raises
+        ------
+        `EngineTimeout`
+            No line arrived in time
+        `EngineError`
+            The engine has exited
+        """
+        try:
+            line = self.lines.get(timeout=timeout)
+        except queue.Empty:
+            raise EngineTimeout(f'No engine output in {timeout}s')
+        if line is None:
+            self.lines.put(None)  # for any later reads
+            raise EngineError('Engine process exited')
+        return line
+
     def send(self, command: str) -> None:
-        self.engine.stdin.write(command + '\n')
-        self.engine.stdin.flush()
+        try:
+            self.engine.stdin.write(command + '\n')
+            self.engine.stdin.flush()
+        except OSError as e:
+            raise EngineError('Engine process exited') from e
 
     def show(self) -> None:
         self.send('d')
         while True:
-            text = self.engine.stdout.readline().rstrip()
+            text = self.read_line()
             print(text)
-            # last line is a bunch of numbers
-            if '0' in text:
+            # last line is the column numbers
+            if text.split() == list('0123456'):
                 break
 
     def setpos(self, posstr: str) -> None:
         self.send(f'position set {posstr}')
 
-    def getbest(self, nodes: int = 1000) -> int:
+    def getbest(self, nodes: int = 1000, timeout: float = None) -> int:
         self.send(f'getbest n {nodes}')
-        ret = self.engine.stdout.readline().strip()
+        ret = self.read_line(timeout).strip()
         if ret == 'end of game':
             return -1
         return int(ret.split(' ')[1])
 
-    def geteval(self, nodes: int = 1000) -> str:
+    def geteval(self, nodes: int = 1000, timeout: float = None) -> str:
         self.send(f'getbest n {nodes}')
-        return self.engine.stdout.readline().strip()
+        return self.read_line(timeout).strip()
+
+    def go(self, nodes: int = 1000, timeout: float = None) -> Iterator[str]:
+        """
+        Searches with `go n`, yielding the output lines as they come, up to
+        and including 'endinfo' or 'end of game'. Closing the generator
+        early stops the search, and reads the rest of its output so the
+        engine is ready for the next command
+        """
+        self.send(f'go n {nodes}')
+        done = False
+        try:
+            while not done:
+                line = self.read_line(timeout)
+                done = line in ('endinfo', 'end of game')
+                yield line
+        except GeneratorExit:
+            if not done:
+                self.send('stop')
+                while self.read_line(timeout) not in ('endinfo',
+                                                      'end of game'):
+                    pass
+            raise
+
+
+class EnginePool:
+    """
+    A fixed number of engine instances, each used by one request at a time
+    """
+
+    def __init__(self, path: str, executable, size: int,
+                 max_waiting: int = 32, wait_timeout: float = 5,
+                 search_timeout: float = 30) -> None:
+        """
+        Parameters
+        ----------
+        path, executable:
+            As per `EngineInstance`
+        size: `int`
+            The number of engine instances
+        max_waiting: `int`
+            Defaults to 32. Requests waiting beyond this are turned away
+        wait_timeout: `float`
+            Defaults to 5. Seconds a request waits for a free engine
+        search_timeout: `float`
+            Defaults to 30. Seconds an engine may take to answer, after which
+            it is restarted
+        """
+        self.path = path
+        self.executable = executable
+        self.size = size
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.search_timeout = search_timeout
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(EngineInstance(path, executable))
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self) -> Iterator[EngineInstance]:
+        """
+        Lends out an engine, which is checked back in on exit. An engine
+        which raised `EngineError` is replaced
+        Raises
+        ------
+        `EngineBusy`
+            No engine became free in time, or too many requests are waiting
+        """
+        with self.lock:
+            if self.waiting >= self.max_waiting:
+                raise EngineBusy('Too many requests waiting')
+            self.waiting += 1
+        try:
+            eng = self.idle.get(timeout=self.wait_timeout)
+        except queue.Empty:
+            raise EngineBusy(f'No engine free in {self.wait_timeout}s')
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        try:
+            yield eng
+        except EngineError:
+            # its output may now belong to an unfinished command
+            eng.kill()
+            eng = None
+            raise
+        finally:
+            self.checkin(eng)
+
+    def checkin(self, eng: EngineInstance = None) -> None:
+        """
+        Returns an engine to the pool, starting a new one in place of None
+        """
+        if eng is None:
+            try:
+                eng = EngineInstance(self.path, self.executable)
+            except (EngineError, OSError):
+                # the pool stays a size down until a later restart works
+                threading.Timer(self.wait_timeout, self.checkin).start()
+                return
+        self.idle.put(eng)
+
+    def geteval(self, posstr: str, nodes: int = 1000) -> str:
+        """
+        Parameters
+        ----------
+        posstr: `str`
+            The position, as per `EngineInstance.setpos`
+        nodes: `int`
+            Defaults to 1000. The nodes to search
+        Returns
+        -------
+        ret: `str`
+            As per `EngineInstance.geteval`
+        """
+        with self.checkout() as eng:
+            eng.setpos(posstr)
+            return eng.geteval(nodes, self.search_timeout)
+
+    def stream(self, posstr: str,
+               nodes: int = 1000) -> Iterator[Tuple[str, dict]]:
+        """
+        Searches while reporting progress. Closing the generator early, as
+        when the client goes away, stops the search and frees the engine
+        Parameters
+        ----------
+        posstr: `str`
+            The position, as per `EngineInstance.setpos`
+        nodes: `int`
+            Defaults to 1000. The nodes to search
+        Yields
+        ------
+        `Tuple[str, dict]`
+            ('info', `parse_info`) as the search goes, then ('bestmove',
+            {'move', 'q', 'nodes'}) of the most visited move, or ('end', {})
+            if the game is over
+        """
+        with self.checkout() as eng:
+            eng.setpos(posstr)
+            children = []
+            with closing(eng.go(nodes, self.search_timeout)) as lines:
+                for line in lines:
+                    words = line.split()
+                    if line == 'end of game':
+                        yield 'end', {}
+                    elif words[0] == 'info':
+                        yield 'info', parse_info(line)
+                    elif words[0] == '[NODE]':
+                        # [NODE] move M N n P p Q q
+                        children.append((int(words[4]), float(words[8]),
+                                         int(words[2])))
+            if children:
+                visits, q, move = max(children)
+                yield 'bestmove', {'move': move, 'q': q,
+                                   'nodes': sum(c[0] for c in children)}
+
+    def evaluate_positions(self, posstrs: Sequence[str],
+                           nodes: int = 1000) -> List[dict]:
+        """
+        Searches several positions at once, on as many engines as are in
+        the pool. The engine has no call for the raw network output, so
+        unlike `analysis.evaluate_positions` there is no value or policy
+        Returns
+        -------
+        results: `List[dict]`
+            'position', then 'move' and 'q' as per `getbest`, with a None
+            move for games which are over
+        """
+        def search(posstr: str) -> dict:
+            answer = self.geteval(posstr, nodes)
+            if answer == 'end of game':
+                return {'position': posstr, 'move': None, 'q': None}
+            q, move = answer.split()
+            return {'position': posstr, 'move': int(move), 'q': float(q)}
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(search, posstrs))
+
+    def stats(self) -> dict:
+        return {'engines': self.size, 'idle': self.idle.qsize(),
+                'waiting': self.waiting}
+
+
+if __name__ == '__main__':
+    # smoke test: the engine answers from the start position
+    print(f'Engine: {os.path.abspath(ENGINE_FILE)}')
+    eng = EngineInstance(*os.path.split(ENGINE_FILE))
+    eng.setpos('7/7/7/7/7/7')
+    print(f'getbest: {eng.geteval(200)}')
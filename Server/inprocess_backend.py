@@ -0,0 +1,238 @@
+"""
+In-process search backend for the server, in place of the engine
+processes. Every request runs an mcts_v2 search on its own thread, and the
+leaf evaluations of all the searches are merged into shared `predict` calls
+by one `BatchedEvaluator`, so many players share the network's batching.
+Running this file compares one search at a time against concurrent ones.
+Usage: python inprocess_backend.py MODEL_FILE [--clients C] [--nodes N]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, List, Sequence, Tuple
+
+# the search code lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analysis import evaluate_positions
+from c4game import C4Game
+from mcts_v2 import MCTS
+from parallel_search import BatchedEvaluator
+
+from engine_wrapper import EngineBusy
+
+
+class InProcessBackend:
+    """
+    Answers requests as per `EnginePool`, with searches in this process
+    """
+
+    def __init__(self, network, max_searches: int = 16,
+                 max_waiting: int = 32, wait_timeout: float = 5,
+                 batch_size: int = 8, c_puct: float = 3,
+                 max_batch: int = 256, max_wait: float = 0.002) -> None:
+        """
+        Parameters
+        ----------
+        network: `keras.models.Model`
+            The neural network, with its predict function made
+        max_searches: `int`
+            Defaults to 16. Searches running at once
+        max_waiting: `int`
+            Defaults to 32. Requests waiting beyond this are turned away
+        wait_timeout: `float`
+            Defaults to 5. Seconds a request waits to start its search
+        batch_size: `int`
+            Defaults to 8. Leaves each search collects per evaluation
+        c_puct: `float`
+            Defaults to 3. Constant controlling exploration
+        max_batch, max_wait:
+            As per `BatchedEvaluator`
+        """
+        self.evaluator = BatchedEvaluator(network, max_batch,
+                                          max_wait).start()
+        self.max_searches = max_searches
+        self.slots = threading.BoundedSemaphore(max_searches)
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.batch_size = batch_size
+        self.c_puct = c_puct
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.searches = 0
+
+    @classmethod
+    def from_model_file(cls, path: str, **kwargs) -> 'InProcessBackend':
+        from keras.models import load_model
+
+        model = load_model(path)
+        model._make_predict_function()  # used from the evaluator thread
+        return cls(model, **kwargs)
+
+    def close(self) -> None:
+        self.evaluator.stop()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        Holds one of the `max_searches` search slots
+        Raises
+        ------
+        `EngineBusy`
+            No slot became free in time, or too many requests are waiting
+        """
+        with self.lock:
+            if self.waiting >= self.max_waiting:
+                raise EngineBusy('Too many requests waiting')
+            self.waiting += 1
+        try:
+            if not self.slots.acquire(timeout=self.wait_timeout):
+                raise EngineBusy(f'No search slot in {self.wait_timeout}s')
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+    def search(self, position: C4Game, nodes: int) -> MCTS:
+        """
+        Parameters
+        ----------
+        position: `C4Game`
+            The position to search
+        nodes: `int`
+            The playouts to make
+        Returns
+        -------
+        eng: `MCTS`
+            The finished search, with at least one move visited
+        Raises
+        ------
+        `EngineBusy`
+            As per `slot`
+        """
+        with self.slot():
+            eng = MCTS(position, False, self.evaluator, self.c_puct, nodes,
+                       self.batch_size)
+            eng.playout_to_max()
+            eng.best_child()  # extends a search too short to visit a move
+            with self.lock:
+                self.searches += 1
+            return eng
+
+    def geteval(self, posstr: str, nodes: int = 1000) -> str:
+        """
+        Parameters
+        ----------
+        posstr: `str`
+            The position, as per `C4Game.from_string`
+        nodes: `int`
+            Defaults to 1000. The playouts to make
+        Returns
+        -------
+        ret: `str`
+            `Q move` of the most visited move, or 'end of game', as the
+            engine's `getbest` answers
+        Raises
+        ------
+        `ValueError`
+            The position string is malformed
+        """
+        position = C4Game.from_string(posstr)
+        if position.check_terminal() is not None:
+            return 'end of game'
+        eng = self.search(position, nodes)
+        best = eng.best_child()
+        return f'{best.Q} {best.move}'
+
+    def evaluate_positions(self, posstrs: Sequence[str],
+                           nodes: int = 0) -> List[dict]:
+        """
+        As per `analysis.evaluate_positions`, on the shared evaluator. The
+        request takes one search slot, and searches its positions
+        `max_searches` at a time
+        """
+        with self.slot():
+            return evaluate_positions(
+                self.evaluator, posstrs, nodes, self.evaluator.max_batch,
+                self.max_searches, self.c_puct, self.batch_size)
+
+    def stream(self, posstr: str, nodes: int = 1000,
+               step: int = 200) -> Iterator[Tuple[str, dict]]:
+        """
+        As per `EnginePool.stream`. The search is run `step` playouts at a
+        time and stops between steps once the generator is closed
+        """
+        position = C4Game.from_string(posstr)
+        if position.check_terminal() is not None:
+            yield 'end', {}
+            return
+        with self.slot():
+            eng = MCTS(position, False, self.evaluator, self.c_puct, 0,
+                       self.batch_size)
+            while eng.top_node.N < nodes:
+                eng.playouts = min(nodes, eng.playouts + step)
+                eng.playout_to_max()
+                pv = eng.get_pv()
+                if pv:  # as the engine, no info before a move is visited
+                    yield 'info', {'nodes': eng.top_node.N,
+                                   'q': float(pv[0].Q),
+                                   'pv': [node.move for node in pv]}
+            best = eng.best_child()
+            with self.lock:
+                self.searches += 1
+        yield 'bestmove', {'move': best.move, 'q': float(best.Q),
+                           'nodes': eng.top_node.N}
+
+    def stats(self) -> dict:
+        calls = self.evaluator.calls
+        return {'max_searches': self.max_searches, 'waiting': self.waiting,
+                'searches': self.searches, 'predict_calls': calls,
+                'positions': self.evaluator.positions,
+                'mean_batch': self.evaluator.positions / max(1, calls)}
+
+
+def throughput(backend: InProcessBackend, positions, clients: int,
+               nodes: int) -> float:
+    """
+    Returns
+    -------
+    evals_per_s: `float`
+        Network evaluations per second while `clients` request at once
+    """
+    before = backend.evaluator.positions
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(lambda p: backend.geteval(p, nodes), positions))
+    return (backend.evaluator.positions - before) / (time.time() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='In-process backend '
+                                     'throughput')
+    parser.add_argument('model', help='keras model file')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--nodes', type=int, default=800)
+    args = parser.parse_args()
+
+    backend = InProcessBackend.from_model_file(
+        args.model, max_searches=args.clients)
+    positions = ['7/7/7/7/7/7', '7/7/7/7/7/3x3', '7/7/7/7/3o3/3x3',
+                 '7/7/7/7/3o3/3xx2'] * args.clients
+    try:
+        for clients in (1, args.clients):
+            rate = throughput(backend, positions, clients, args.nodes)
+            print(f'{clients} clients: {rate:.0f} evals/s')
+        print(backend.stats())
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    main()
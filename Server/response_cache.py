@@ -0,0 +1,155 @@
+"""
+LRU cache of engine answers, shared by all requests
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+def normalize(posstr: str) -> Optional[Tuple[str, bool]]:
+    """
+    Parameters
+    ----------
+    posstr: `str`
+        A position as per `EngineInstance.setpos`, top row first, digits
+        counting empty squares
+    Returns
+    -------
+    key: `Optional[Tuple[str, bool]]`
+        The canonical string of the position or its left-right mirror,
+        whichever is smaller, and True if it is the mirror. None if the
+        position string is malformed
+    """
+    rows = posstr.lower().split('/')
+    if len(rows) != 6:
+        return None
+    grid = []
+    for row in rows:
+        cells = ''
+        for ch in row:
+            if ch.isdigit():
+                cells += '.' * int(ch)
+            elif ch in 'xo':
+                cells += ch
+            else:
+                return None
+        if len(cells) != 7:
+            return None
+        grid.append(cells)
+    plain = '/'.join(grid)
+    mirror = '/'.join(row[::-1] for row in grid)
+    if mirror < plain:
+        return mirror, True
+    return plain, False
+
+
+def mirror_answer(answer: str) -> str:
+    """
+    Maps a `Q move` answer between a position and its mirror
+    """
+    parts = answer.split(' ')
+    if len(parts) != 2 or not parts[1].isdigit():
+        return answer  # such as 'end of game'
+    return f'{parts[0]} {6 - int(parts[1])}'
+
+
+class ResponseCache:
+    """
+    Engine answers keyed by normalized position. An answer searched to more
+    nodes also answers requests for fewer nodes
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600) -> None:
+        """
+        Parameters
+        ----------
+        max_entries: `int`
+            Defaults to 10000. The least recently used answers are dropped
+            beyond this
+        ttl: `float`
+            Defaults to 3600. Seconds an answer stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (nodes, answer, time stored, nodes reported by the search)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, posstr: str, nodes: int) -> Optional[str]:
+        """
+        Parameters
+        ----------
+        posstr: `str`
+            The position
+        nodes: `int`
+            The nodes the answer must have been searched to at least
+        Returns
+        -------
+        answer: `Optional[str]`
+            The cached answer, None on a miss
+        """
+        found = self.lookup(posstr, nodes)
+        return found[0] if found is not None else None
+
+    def lookup(self, posstr: str, nodes: int) -> Optional[Tuple[str, int]]:
+        """
+        As per `get`
+        Returns
+        -------
+        found: `Optional[Tuple[str, int]]`
+            The cached answer and the nodes it was searched with, which may
+            be more than `nodes`. None on a miss
+        """
+        key = normalize(posstr)
+        with self.lock:
+            entry = self.entries.get(key and key[0])
+            if entry is not None and time.time() - entry[2] > self.ttl:
+                del self.entries[key[0]]
+                entry = None
+            if entry is None or entry[0] < nodes:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key[0])
+            self.hits += 1
+        answer = mirror_answer(entry[1]) if key[1] else entry[1]
+        return answer, entry[3]
+
+    def put(self, posstr: str, nodes: int, answer: str,
+            searched: int = None) -> None:
+        """
+        Stores an answer, unless a deeper one is already stored
+        Parameters
+        ----------
+        posstr: `str`
+            The position
+        nodes: `int`
+            The nodes the answer was asked for
+        answer: `str`
+            The engine's answer
+        searched: `int`
+            Defaults to None, for `nodes`. The nodes the search reported
+        """
+        key = normalize(posstr)
+        if key is None:
+            return
+        if key[1]:
+            answer = mirror_answer(answer)
+        with self.lock:
+            entry = self.entries.get(key[0])
+            if (entry is not None and entry[0] > nodes and
+                    time.time() - entry[2] <= self.ttl):
+                return
+            self.entries[key[0]] = (nodes, answer, time.time(),
+                                    nodes if searched is None else searched)
+            self.entries.move_to_end(key[0])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'entries': len(self.entries), 'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
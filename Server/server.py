@@ -1,16 +1,106 @@
 """
 2018 April fools
 """
-from flask import Flask, Response, render_template
+import itertools
+import json
+import os
 
-from engine_wrapper import EngineInstance
+from flask import Flask, Response, jsonify, render_template, request
+
+from engine_wrapper import ENGINE_FILE, EngineBusy, EngineError, EnginePool
+from response_cache import ResponseCache
 
 
 app = Flask(__name__)
 app.secret_key = 'I DO NOT REALLY CARE ABOUT THIS REALLY NOT GONNA LIE'
 app.send_file_max_age_default = 0
 
-engine = EngineInstance('Engine', 'C4UCT.exe')
+# each request gets an engine of its own, so requests run side by side
+ENGINES = int(os.environ.get('C4UCT_ENGINES', 2))
+# 'engine' for engine processes, 'inprocess' to search in this process with
+# the keras model C4UCT_MODEL, batching the network across requests
+BACKEND = os.environ.get('C4UCT_BACKEND', 'engine')
+if BACKEND == 'inprocess':
+    from inprocess_backend import InProcessBackend
+    pool = InProcessBackend.from_model_file(os.environ['C4UCT_MODEL'],
+                                            max_searches=ENGINES)
+else:
+    pool = EnginePool(*os.path.split(ENGINE_FILE), ENGINES)
+# positions per bulk request, a whole game fits easily
+MAX_BULK = int(os.environ.get('C4UCT_MAX_BULK', 256))
+# the same early positions are asked for over and over
+cache = ResponseCache(int(os.environ.get('C4UCT_CACHE_SIZE', 10000)),
+                      float(os.environ.get('C4UCT_CACHE_TTL', 3600)))
+
+
+def evaluate(posstr: str, nodes: int = 1000) -> Response:
+    answer = cache.get(posstr, nodes)
+    if answer is not None:
+        return Response(answer, mimetype='text/plain')
+    try:
+        answer = pool.geteval(posstr, nodes)
+    except EngineBusy:
+        return Response('busy', status=503, mimetype='text/plain',
+                        headers={'Retry-After': '1'})
+    except EngineError:
+        return Response('engine error', status=504, mimetype='text/plain')
+    except ValueError:
+        return Response('bad position', status=400, mimetype='text/plain')
+    cache.put(posstr, nodes, answer)
+    return Response(answer, mimetype='text/plain')
+
+
+def event(kind: str, data: dict) -> str:
+    return f'event: {kind}\ndata: {json.dumps(data)}\n\n'
+
+
+def stream(posstr: str, nodes: int = 1000) -> Response:
+    """
+    Server-sent events of the search: 'info' events with the nodes, eval
+    and pv as the search deepens, then 'bestmove', or 'end' if the game is
+    over. A client which has seen enough closes the connection, and the
+    search is stopped at the next event
+    """
+    found = cache.lookup(posstr, nodes)
+    answer = found and found[0]
+    if answer is not None:
+        if answer == 'end of game':
+            search = (e for e in [('end', {})])
+        else:
+            # the nodes of the cached search, which may be deeper
+            q, move = answer.split()
+            search = (e for e in [('bestmove', {
+                'move': int(move), 'q': float(q), 'nodes': found[1]})])
+    else:
+        search = pool.stream(posstr, nodes)
+    # start the search here, so a busy server still gets a status code
+    try:
+        first = next(search)
+    except EngineBusy:
+        return Response('busy', status=503, mimetype='text/plain',
+                        headers={'Retry-After': '1'})
+    except EngineError:
+        return Response('engine error', status=504, mimetype='text/plain')
+    except ValueError:
+        return Response('bad position', status=400, mimetype='text/plain')
+
+    def events():
+        try:
+            for kind, data in itertools.chain([first], search):
+                if kind == 'bestmove' and answer is None:
+                    cache.put(posstr, nodes, f'{data["q"]} {data["move"]}',
+                              data['nodes'])
+                elif kind == 'end' and answer is None:
+                    cache.put(posstr, nodes, 'end of game')
+                yield event(kind, data)
+        except EngineError:
+            yield event('error', {})
+        finally:
+            # on a disconnect, stops the search and frees the engine
+            search.close()
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/', methods=['GET'])
@@ -20,16 +110,59 @@ def index():
 
 @app.route('/eng/<p1>/<p2>/<p3>/<p4>/<p5>/<p6>', methods=['GET'])
 def eng_compute(p1, p2, p3, p4, p5, p6):
-    engine.setpos(f'{p1}/{p2}/{p3}/{p4}/{p5}/{p6}')
-    return Response(engine.geteval(), mimetype='text/plain')
+    return evaluate(f'{p1}/{p2}/{p3}/{p4}/{p5}/{p6}')
 
 
 @app.route('/eng/<p1>/<p2>/<p3>/<p4>/<p5>/<p6>/<int:n>', methods=['GET'])
 def eng_compute_n(p1, p2, p3, p4, p5, p6, n):
     n = min(30000, max(10, n))
-    engine.setpos(f'{p1}/{p2}/{p3}/{p4}/{p5}/{p6}')
-    return Response(engine.geteval(n), mimetype='text/plain')
+    return evaluate(f'{p1}/{p2}/{p3}/{p4}/{p5}/{p6}', n)
+
+
+@app.route('/stream/<p1>/<p2>/<p3>/<p4>/<p5>/<p6>/<int:n>', methods=['GET'])
+def stream_compute(p1, p2, p3, p4, p5, p6, n):
+    n = min(30000, max(10, n))
+    return stream(f'{p1}/{p2}/{p3}/{p4}/{p5}/{p6}', n)
+
+
+@app.route('/bulk', methods=['POST'])
+def bulk():
+    """
+    Evaluates a JSON body of {"positions": [...], "nodes": n}. With the
+    in-process backend each position gets the network's value and policy,
+    and with nodes, the best move of a search; engines only search
+    """
+    data = request.get_json(silent=True)
+    if (not isinstance(data, dict) or
+            not isinstance(data.get('positions'), list) or
+            not all(isinstance(p, str) for p in data['positions'])):
+        return Response('expected {"positions": [...]}', status=400,
+                        mimetype='text/plain')
+    if len(data['positions']) > MAX_BULK:
+        return Response(f'at most {MAX_BULK} positions', status=413,
+                        mimetype='text/plain')
+    try:
+        nodes = int(data.get('nodes', 0))
+    except (TypeError, ValueError):
+        return Response('bad nodes', status=400, mimetype='text/plain')
+    if nodes or BACKEND != 'inprocess':
+        nodes = min(30000, max(10, nodes))
+    try:
+        results = pool.evaluate_positions(data['positions'], nodes)
+    except EngineBusy:
+        return Response('busy', status=503, mimetype='text/plain',
+                        headers={'Retry-After': '1'})
+    except EngineError:
+        return Response('engine error', status=504, mimetype='text/plain')
+    except ValueError:
+        return Response('bad position', status=400, mimetype='text/plain')
+    return jsonify(results=results)
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(engines=pool.stats(), cache=cache.stats())
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8421, debug=True)
+    app.run(host='0.0.0.0', port=8421, debug=True, threaded=True)
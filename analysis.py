@@ -0,0 +1,149 @@
+"""
+Bulk evaluation of positions. The network's value and policy of every
+position are computed in large batches, and each position can also get a
+shallow search for its best move, with the searches running side by side
+and sharing one `BatchedEvaluator`.
+Positions are read one per line, in the engine's `position set` format, and
+the results are written as JSON lines.
+Usage: python analysis.py MODEL_FILE [--nodes N] [--in FILE] [--out FILE]
+"""
+import argparse
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence
+
+import numpy as np
+from keras.models import Model
+
+from c4game import C4Game
+from mcts_v2 import MCTS
+from parallel_search import BatchedEvaluator
+
+
+def best_move(position: C4Game, network: Model, nodes: int,
+              c_puct: float = 3, batch_size: int = 8) -> dict:
+    """
+    Returns
+    -------
+    best: `dict`
+        'move' and 'q' of the most visited move after searching `nodes`
+        playouts of `position`, or more if no move was visited by then
+    """
+    eng = MCTS(position, False, network, c_puct, nodes, batch_size)
+    eng.playout_to_max()
+    best = eng.best_child()
+    return {'move': best.move, 'q': float(best.Q)}
+
+
+def evaluate_positions(network: Model, posstrs: Sequence[str],
+                       nodes: int = 0, batch_size: int = 256,
+                       searches: int = 8, c_puct: float = 3,
+                       search_batch: int = 8) -> List[dict]:
+    """
+    Parameters
+    ----------
+    network: `keras.models.Model`
+        The neural network, or a started `BatchedEvaluator` to share
+    posstrs: `Sequence[str]`
+        The positions, as per `C4Game.from_string`
+    nodes: `int`
+        Defaults to 0. Playouts of the search for the best move of each
+        position, 0 for no search
+    batch_size: `int`
+        Defaults to 256. Positions per network call
+    searches: `int`
+        Defaults to 8. Searches running at once
+    c_puct: `float`
+        Defaults to 3. Constant controlling exploration
+    search_batch: `int`
+        Defaults to 8. Leaves each search collects per evaluation
+    Returns
+    -------
+    results: `List[dict]`
+        For each position in order, 'position', 'value' for the side to move,
+        'policy' over the 7 columns with illegal moves at 0, and with `nodes`,
+        'move' and 'q' of the search. Games which are over get their result
+        as value, a zero policy and a None move
+    Raises
+    ------
+    `ValueError`
+        A position string is malformed
+    """
+    games = [C4Game.from_string(p) for p in posstrs]
+    if not games:
+        return []
+    states = np.array([g.state for g in games])
+    values = []
+    policies = []
+    for start in range(0, len(states), batch_size):
+        value, policy = network.predict(states[start:start + batch_size])
+        values.append(value[:, 0])
+        policies.append(policy)
+    values = np.concatenate(values)
+    policies = np.concatenate(policies)
+
+    results = []
+    for posstr, game, value, policy in zip(posstrs, games, values,
+                                           policies):
+        term = game.check_terminal()
+        if term is not None:
+            # the side to move has lost, or it is a draw
+            results.append({'position': posstr, 'value': -float(term),
+                            'policy': [0.0] * 7})
+            if nodes:
+                results[-1].update(move=None, q=-float(term))
+            continue
+        policy = policy * np.array(game.legal_moves())
+        policy = policy / max(policy.sum(), 1e-10)
+        results.append({'position': posstr, 'value': float(value),
+                        'policy': [float(p) for p in policy]})
+    if not nodes:
+        return results
+
+    ongoing = [i for i, r in enumerate(results) if 'move' not in r]
+    evaluator = network
+    if not isinstance(network, BatchedEvaluator):
+        evaluator = BatchedEvaluator(network, batch_size).start()
+    try:
+        with ThreadPoolExecutor(max_workers=searches) as executor:
+            found = executor.map(
+                lambda i: best_move(games[i], evaluator, nodes, c_puct,
+                                    search_batch), ongoing)
+            for i, best in zip(ongoing, found):
+                results[i].update(best)
+    finally:
+        if evaluator is not network:
+            evaluator.stop()
+    return results
+
+
+def main() -> None:
+    from keras.models import load_model
+
+    parser = argparse.ArgumentParser(description='Bulk position evaluation')
+    parser.add_argument('model', help='keras model file')
+    parser.add_argument('--nodes', type=int, default=0,
+                        help='playouts of the best move search, 0 for none')
+    parser.add_argument('--in', dest='infile', help='defaults to stdin')
+    parser.add_argument('--out', help='defaults to stdout')
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--searches', type=int, default=8)
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    model._make_predict_function()
+    infile = open(args.infile) if args.infile else sys.stdin
+    with infile:
+        posstrs = [line.strip() for line in infile if line.strip()]
+    results = evaluate_positions(model, posstrs, args.nodes, args.batch,
+                                 args.searches)
+    out = open(args.out, 'w') if args.out else sys.stdout
+    for r in results:
+        out.write(json.dumps(r) + '\n')
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Annotates archives of games. Every position of every game is searched, and
+a JSON line per game is written with the search's view of each move played.
+Games are read one per line as the columns played, e.g. `3342` or
+`3 3 4 2`. Several games are searched at once on worker threads sharing one
+`BatchedEvaluator`, and the tree of each ply is reused for the next. Only a
+bounded number of games are read ahead, so memory use does not grow with
+the archive, and results are written in input order as they complete.
+Usage: python annotate.py MODEL_FILE GAMES_FILE [--out FILE] [options]
+"""
+import argparse
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from keras.models import Model
+
+from c4game import C4Game
+from mcts_v2 import MCTS, NodePool
+from parallel_search import BatchedEvaluator
+
+
+def parse_game(line: str) -> List[int]:
+    """
+    Returns
+    -------
+    moves: `List[int]`
+        The columns played, digits with anything else ignored
+    """
+    return [int(c) for c in line if c.isdigit()]
+
+
+def annotate_game(moves: List[int], network: Model, nodes: int,
+                  c_puct: float = 3, batch_size: int = 8,
+                  max_nodes: int = None) -> dict:
+    """
+    Parameters
+    ----------
+    moves: `List[int]`
+        The columns played, from the start position
+    network: `keras.models.Model`
+        The neural network, usually a shared `BatchedEvaluator`
+    nodes: `int`
+        The playouts of each position. Visits kept from the previous ply
+        count towards them. A position is searched further if no move has
+        been visited by then
+    c_puct: `float`
+        Defaults to 3. Constant controlling exploration
+    batch_size: `int`
+        Defaults to 8. Leaves collected per evaluation
+    max_nodes: `int`
+        Defaults to None. The tree's node budget, as per `MCTS`
+    Returns
+    -------
+    annotation: `dict`
+        'plies', with for each move played: 'move', 'best' (the most visited
+        move), 'q' of the best move and 'q_played' of the move played (None
+        if the search never tried it), both for the side to move, 'nodes'
+        and 'visits' of each column. Then 'result' as '1-0', '0-1', '1/2-1/2'
+        or None if the game did not finish
+    Raises
+    ------
+    `ValueError`
+        A move is illegal, or comes after the end of the game
+    """
+    game = C4Game()
+    eng = MCTS(game, False, network, c_puct, nodes, batch_size,
+               max_nodes=max_nodes)
+    plies = []
+    for ply, move in enumerate(moves):
+        if game.check_terminal() is not None:
+            raise ValueError(f'Move {ply} is after the end of the game')
+        if not 0 <= move < 7 or not game.legal_moves()[move]:
+            raise ValueError(f'Move {ply} ({move}) is illegal')
+        eng.playouts = nodes
+        eng.playout_to_max()
+        best = eng.best_child()
+        children = {c.move: c for c in eng.top_node.children}
+        played = children.get(move)
+        plies.append({
+            'move': move,
+            'best': best.move,
+            'q': float(best.Q),
+            'q_played': float(played.Q) if played is not None else None,
+            'nodes': eng.top_node.N,
+            'visits': eng.top_node.visit_counts(),
+        })
+        game.play_move(move)
+        # tree reuse, the rest of the tree goes back to the pool
+        eng.reroot(move)
+    term = game.check_terminal()
+    result = None
+    if term == 0:
+        result = '1/2-1/2'
+    elif term == 1:
+        # the last move won, X plays the odd moves
+        result = '1-0' if len(moves) % 2 else '0-1'
+    return {'plies': plies, 'result': result}
+
+
+def annotate_line(index: int, line: str, network: Model, nodes: int,
+                  **kwargs) -> dict:
+    """
+    As per `annotate_game` for one line of the archive, with the line's
+    'game' index and 'moves'. A line which can not be annotated gets an
+    'error' instead
+    """
+    moves = parse_game(line)
+    record = {'game': index, 'moves': ''.join(map(str, moves))}
+    try:
+        record.update(annotate_game(moves, network, nodes, **kwargs))
+    except ValueError as e:
+        record['error'] = str(e)
+    return record
+
+
+def annotate_file(infile, outfile, network: Model, nodes: int,
+                  workers: int = 8, max_in_flight: int = None,
+                  max_batch: int = 256, **kwargs) -> int:
+    """
+    Parameters
+    ----------
+    infile, outfile:
+        Text files of games in and JSON lines out
+    network: `keras.models.Model`
+        The neural network, with its predict function made
+    nodes: `int`
+        As per `annotate_game`
+    workers: `int`
+        Defaults to 8. Games searched at once
+    max_in_flight: `int`
+        Defaults to None, which is 4 per worker. Games read but not yet
+        written; a slow game holds back the output of the games after it
+    max_batch: `int`
+        Defaults to 256. As per `BatchedEvaluator`
+    kwargs:
+        As per `annotate_game`
+    Returns
+    -------
+    games: `int`
+        The number of games written
+    """
+    max_in_flight = max_in_flight or workers * 4
+    pending = deque()
+    written = 0
+
+    def write_done(limit: int) -> None:
+        # in input order, waiting on the oldest while over the limit
+        nonlocal written
+        while pending and (len(pending) > limit or pending[0].done()):
+            outfile.write(json.dumps(pending.popleft().result()) + '\n')
+            written += 1
+        outfile.flush()
+
+    with BatchedEvaluator(network, max_batch) as evaluator, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        index = 0
+        for line in infile:
+            if not line.strip():
+                continue
+            pending.append(executor.submit(annotate_line, index, line,
+                                           evaluator, nodes, **kwargs))
+            index += 1
+            write_done(max_in_flight - 1)
+        write_done(0)
+    return written
+
+
+def main() -> None:
+    from keras.models import load_model
+
+    parser = argparse.ArgumentParser(description='Annotate archived games')
+    parser.add_argument('model', help='keras model file')
+    parser.add_argument('games', help='one game per line, - for stdin')
+    parser.add_argument('--out', help='defaults to stdout')
+    parser.add_argument('--nodes', type=int, default=800,
+                        help='playouts per position')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--in-flight', type=int, default=None,
+                        help='games read ahead, defaults to 4 per worker')
+    parser.add_argument('--tree-mb', type=float, default=None,
+                        help='memory budget of each search tree')
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    model._make_predict_function()  # used from the evaluator thread
+    max_nodes = None
+    if args.tree_mb:
+        max_nodes = NodePool.nodes_for_memory(args.tree_mb)
+    infile = sys.stdin if args.games == '-' else open(args.games)
+    outfile = open(args.out, 'w') if args.out else sys.stdout
+    start = time.time()
+    try:
+        games = annotate_file(infile, outfile, model, args.nodes,
+                              args.workers, args.in_flight,
+                              max_nodes=max_nodes)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    print(f'{games} games in {time.time() - start:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
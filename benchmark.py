@@ -0,0 +1,196 @@
+"""
+Search benchmark for mcts.py and mcts_v2.py
+Every position of a fixed corpus is searched at a fixed number of playouts.
+With the stub network, the tree cost is measured alone; with a real model,
+the search is measured end to end. Results are written as JSON so runs can
+be compared.
+Usage: python benchmark.py [--model MODEL_FILE] [--out FILE] [options]
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from c4game import C4Game
+import mcts
+import mcts_v2
+from telemetry import CountingNetwork
+
+
+CORPUS_FILE = 'benchmark_positions.txt'
+
+
+class StubNetwork:
+    """
+    Network stand-in returning a draw value and a uniform policy, so no time
+    is spent on inference
+    """
+
+    def predict(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return np.zeros((len(x), 1)), np.full((len(x), 7), 1 / 7)
+
+
+def load_corpus(path: str = CORPUS_FILE) -> List[Tuple[str, str]]:
+    """
+    Parameters
+    ----------
+    path: `str`
+        The corpus file, one `PHASE MOVES` position per line
+    Returns
+    -------
+    corpus: `List[Tuple[str, str]]`
+        The phase and move string of every position
+    """
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            phase, moves = line.split()
+            corpus.append((phase, '' if moves == '-' else moves))
+    return corpus
+
+
+def position_from_moves(moves: str) -> C4Game:
+    position = C4Game()
+    for m in moves:
+        position.play_move(int(m))
+    return position
+
+
+def make_searcher(engine: str, position: C4Game, network, playouts: int,
+                  batch_size: int):
+    if engine == 'mcts':
+        return mcts.MCTS(position, False, network, 3, playouts)
+    return mcts_v2.MCTS(position, False, network, 3, playouts, batch_size)
+
+
+def run_engine(engine: str, network, corpus: List[Tuple[str, str]],
+               playouts: int, batch_size: int, memory: bool = True) -> dict:
+    """
+    Searches every position of the corpus once with a fresh searcher
+    Parameters
+    ----------
+    engine: `str`
+        'mcts' or 'mcts_v2'
+    network:
+        The network, wrapped here to count evaluations
+    corpus: `List[Tuple[str, str]]`
+        As per `load_corpus`
+    playouts: `int`
+        Playouts per position
+    batch_size: `int`
+        The mcts_v2 leaf batch size
+    memory: `bool`
+        Defaults to True. Also measure the peak traced memory of a search,
+        in a separate untimed pass
+    Returns
+    -------
+    result: `dict`
+        The benchmark metrics
+    """
+    counter = CountingNetwork(network)
+    latencies = []
+    phases: Dict[str, List[float]] = {}
+    visits = 0
+    for phase, moves in corpus:
+        searcher = make_searcher(engine, position_from_moves(moves), counter,
+                                 playouts, batch_size)
+        start = time.perf_counter()
+        searcher.playout_to_max()
+        elapsed = time.perf_counter() - start
+        latencies.append(elapsed)
+        phases.setdefault(phase, []).append(elapsed)
+        visits += searcher.top_node.N
+    total = sum(latencies)
+    result = {
+        'engine': engine,
+        'positions': len(corpus),
+        'playouts': playouts,
+        'seconds': total,
+        'nodes_per_s': visits / total,
+        'evals_per_s': counter.positions / total,
+        'predict_calls': counter.calls,
+        'latency_p50_ms': float(np.percentile(latencies, 50)) * 1000,
+        'latency_p99_ms': float(np.percentile(latencies, 99)) * 1000,
+        'phase_latency_p50_ms': {p: float(np.percentile(v, 50)) * 1000
+                                 for p, v in phases.items()},
+    }
+    if memory:
+        peak = 0
+        for _, moves in corpus:
+            searcher = make_searcher(engine, position_from_moves(moves),
+                                     network, playouts, batch_size)
+            tracemalloc.start()
+            searcher.playout_to_max()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        result['peak_memory_bytes'] = peak
+    return result
+
+
+def compare(results: List[dict], baseline: List[dict]) -> None:
+    """
+    Prints the change of each metric against a previous run
+    """
+    old = {(r['engine'], r['network']): r for r in baseline}
+    for r in results:
+        b = old.get((r['engine'], r['network']))
+        if b is None:
+            continue
+        for key in ('nodes_per_s', 'evals_per_s', 'latency_p50_ms',
+                    'latency_p99_ms', 'peak_memory_bytes'):
+            if key in r and key in b and b[key]:
+                print(f'{r["engine"]}/{r["network"]} {key}: {b[key]:.5g} -> '
+                      f'{r[key]:.5g} ({100 * (r[key] / b[key] - 1):+.1f}%)',
+                      file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='MCTS search benchmark')
+    parser.add_argument('--model', help='also benchmark with this keras model')
+    parser.add_argument('--corpus', default=CORPUS_FILE)
+    parser.add_argument('--engines', default='mcts,mcts_v2')
+    parser.add_argument('--playouts', type=int, default=800)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the peak memory pass')
+    parser.add_argument('--out', help='write the JSON here, not to stdout')
+    parser.add_argument('--baseline', help='JSON of a previous run to '
+                        'compare against')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    networks = [('stub', StubNetwork())]
+    if args.model:
+        from keras.models import load_model
+        networks.append(('model', load_model(args.model)))
+
+    results = []
+    for name, network in networks:
+        for engine in args.engines.split(','):
+            result = run_engine(engine, network, corpus, args.playouts,
+                                args.batch_size, not args.no_memory)
+            result['network'] = name
+            results.append(result)
+            print(f'{engine}/{name}: {result["nodes_per_s"]:.0f} nodes/s',
+                  file=sys.stderr)
+    report = {'corpus': args.corpus, 'model': args.model,
+              'batch_size': args.batch_size, 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -91,21 +91,142 @@ class C4Game:
         ret: `int`
             Unique integer representing state
         """
+        return C4Game.encode_position(self.position, self.to_move)
+
+    @classmethod
+    def encode_position(cls, position: np.ndarray, to_move: int) -> int:
+        """
+        Parameters
+        ----------
+        position: `np.ndarray`
+            A (7, 6) board, column by column
+        to_move: `int`
+            -1 if p1 is to move, 1 if p2 is to move
+        Returns
+        -------
+        ret: `int`
+            Unique integer representing the position and side to move
+        """
         # 85 bits required
         # 84 bits for position
         # 1 bit for turn (kind of redundant, but why not)
         # maybe player sets up some strange position
         ret = 0
-        for r, row in enumerate(self.position):
+        for r, row in enumerate(position):
             for c, v in enumerate(row):
                 if v == -1:
-                    ret |= 1 << 42 + r * 7 + c
+                    ret |= 1 << 42 + r * 6 + c
                 elif v == 1:
-                    ret |= 1 << r * 7 + c
-        if self.to_move == -1:
+                    ret |= 1 << r * 6 + c
+        if to_move == -1:
             ret |= 1 << 84
         return ret
 
+    def canonical_key(self) -> Tuple[int, bool]:
+        """
+        The board is symmetric about the middle column, so a position and its
+        left-right mirror share the same evaluation (with the policy reversed)
+        Returns
+        -------
+        key: `int`
+            The smaller of `simple_state` for this position and for its mirror
+        mirrored: `bool`
+            True if `key` was taken from the mirrored position. Any vector
+            indexed by column (such as a policy) must then be reversed to map
+            between this position and `key`
+        """
+        key = self.simple_state()
+        mirror_key = C4Game.encode_position(self.position[::-1], self.to_move)
+        if mirror_key < key:
+            return mirror_key, True
+        return key, False
+
+    @classmethod
+    def states_from_moves(cls, moves: Iterable[int],
+                          history_frames: int = 1) -> np.ndarray:
+        """
+        Builds the input planes of a whole game at once, without playing it
+        out move by move
+        Parameters
+        ----------
+        moves: `Iterable[int]`
+            The columns played from the start position
+        history_frames: `int`
+            Defaults to 1. The amount of history frames, as per `__init__`
+        Returns
+        -------
+        states: `np.ndarray`
+            Shape (len(moves), 7, 6, 1 + 2 * history_frames). The `state` of
+            the position before each move
+        """
+        cols = np.asarray(moves, dtype=np.intp)
+        n = len(cols)
+        # the row of each piece is the number of earlier moves in its column
+        onehot = np.zeros((n, 7), dtype=np.int8)
+        onehot[np.arange(n), cols] = 1
+        rows = (np.cumsum(onehot, axis=0) - onehot)[np.arange(n), cols]
+        players = np.where(np.arange(n) % 2, 1, -1).astype(np.int8)
+        placed = np.zeros((n, 7, 6), dtype=np.int8)
+        placed[np.arange(n), cols, rows] = players
+        # boards[i + history_frames - 1] is the board before move i, with
+        # empty boards in front for the history of the first moves
+        boards = np.concatenate([np.zeros((history_frames, 7, 6), np.int8),
+                                 np.cumsum(placed, axis=0)[:-1]])
+        frames = boards[np.arange(n)[:, None] + np.arange(history_frames)]
+        turn = np.broadcast_to((players == -1)[:, None, None, None],
+                               (n, 1, 7, 6))
+        stones = np.stack([frames == -1, frames == 1], axis=2)
+        planes = np.concatenate(
+            [turn, stones.reshape(n, 2 * history_frames, 7, 6)], axis=1)
+        return np.moveaxis(planes, 1, 3).astype('float')
+
+    @classmethod
+    def from_string(cls, posstr: str, to_move: str = None) -> 'C4Game':
+        """
+        Parameters
+        ----------
+        posstr: `str`
+            The position, rows from the top separated by '/', with 'X' and
+            'O' for pieces and digits counting empty squares, as per the
+            engine's `position set`
+        to_move: `str`
+            Defaults to None. 'X' or 'O', the side to move. If None, it is X
+            when both sides have as many pieces, else O
+        Returns
+        -------
+        game: `C4Game`
+            A game at the position, without move history
+        Raises
+        ------
+        `ValueError`
+            The position string is malformed
+        """
+        rows = posstr.upper().split('/')
+        if len(rows) != 6:
+            raise ValueError(f'Expected 6 rows, got {len(rows)}')
+        game = C4Game()
+        for r, row in enumerate(rows):
+            cells = ''
+            for ch in row:
+                if ch.isdigit():
+                    cells += ' ' * int(ch)
+                elif ch in 'XO':
+                    cells += ch
+                else:
+                    raise ValueError(f'Unexpected character {ch!r}')
+            if len(cells) != 7:
+                raise ValueError(f'Row {row!r} is not 7 squares wide')
+            for c, ch in enumerate(cells):
+                # the top row first, the position is stored column by column
+                if ch != ' ':
+                    game.position[c, 5 - r] = -1 if ch == 'X' else 1
+        if to_move is None:
+            x_count = (game.position == -1).sum()
+            to_move = 'X' if x_count == (game.position == 1).sum() else 'O'
+        game.to_move = -1 if to_move.upper() == 'X' else 1
+        game.position_history = [game.position.copy()]
+        return game
+
     def state_copy(self) -> 'C4Game':
         """
         Returns
@@ -132,6 +253,33 @@ class C4Game:
         """
         return tuple(int(x[-1] == 0) for x in self.position)
 
+    def winning_moves(self) -> Tuple[int, ...]:
+        """
+        Returns
+        -------
+        moves: `Tuple[int, ...]`
+            The legal columns which would make four in a row for the side to
+            move. Only the lines through each landing square are checked
+        """
+        grid = self.position.tolist()
+        player = self.to_move
+        moves = []
+        for col in range(7):
+            row = sum(1 for x in grid[col] if x)
+            if row == 6:
+                continue
+            for dc, dr in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                count = 1
+                for sign in (1, -1):
+                    c, r = col + sign * dc, row + sign * dr
+                    while 0 <= c < 7 and 0 <= r < 6 and grid[c][r] == player:
+                        count += 1
+                        c, r = c + sign * dc, r + sign * dr
+                if count >= 4:
+                    moves.append(col)
+                    break
+        return tuple(moves)
+
     def play_move(self, col: int) -> None:
         """
         Parameters
@@ -234,3 +382,173 @@ class C4Game:
             String representation of the current state, plus ID of object
         """
         return f'{str(self)}\nid={str(id(self))}'
+
+
+class C4GameBatch:
+    """
+    Many games of connect-4 held as NumPy arrays, so that one call advances,
+    checks or encodes every game at once
+    """
+
+    # (column step, row step) of each line direction
+    DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+    def __init__(self, size: int, history_frames: int = 1) -> None:
+        """
+        Parameters
+        ----------
+        size: `int`
+            The number of games, all starting from the empty board
+        history_frames: `int`
+            Defaults to 1. The amount of history frames to feed to the neural
+            network.
+        """
+        self.history_frames = history_frames
+        # boards column by column as per `C4Game.position`, oldest frame
+        # first. The last frame is the current board
+        self.history = np.zeros((size, history_frames, 7, 6), dtype=np.int8)
+        self.heights = np.zeros((size, 7), dtype=np.int8)  # pieces in column
+        self.to_move = np.full(size, -1, dtype=np.int8)
+        self.move_count = np.zeros(size, dtype=np.int16)
+
+    @classmethod
+    def from_games(cls, games: Iterable[C4Game]) -> 'C4GameBatch':
+        """
+        Parameters
+        ----------
+        games: `Iterable[C4Game]`
+            The games to copy, all with the same `history_frames`
+        Returns
+        -------
+        batch: `C4GameBatch`
+            A batch holding the current state of each game
+        """
+        games = list(games)
+        frames = games[0].history_frames if games else 1
+        batch = cls(len(games), frames)
+        for i, game in enumerate(games):
+            last_n = game.position_history[-frames:]
+            batch.history[i, frames - len(last_n):] = last_n
+            batch.to_move[i] = game.to_move
+            batch.move_count[i] = len(game.move_history)
+        batch.heights[:] = (batch.grids != 0).sum(axis=2)
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.to_move)
+
+    @property
+    def grids(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        grids: `np.ndarray`
+            A view of the current (size, 7, 6) boards
+        """
+        return self.history[:, -1]
+
+    @property
+    def state(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        ret: `np.ndarray`
+            Inputs of shape (size, 7, 6, 1 + 2 * history_frames), plane for
+            plane as per `C4Game.state`
+        """
+        size = len(self)
+        turn = np.broadcast_to((self.to_move == -1)[:, None, None, None],
+                               (size, 1, 7, 6))
+        stones = np.stack([self.history == -1, self.history == 1], axis=2)
+        planes = np.concatenate(
+            [turn, stones.reshape(size, 2 * self.history_frames, 7, 6)],
+            axis=1)
+        return np.moveaxis(planes, 1, 3).astype(np.float32)
+
+    def copy(self) -> 'C4GameBatch':
+        return self.take(np.arange(len(self)))
+
+    def take(self, index: np.ndarray) -> 'C4GameBatch':
+        """
+        Parameters
+        ----------
+        index: `np.ndarray`
+            Indices (repeats allowed) or a boolean mask of the games to take
+        Returns
+        -------
+        batch: `C4GameBatch`
+            A new batch holding copies of the selected games
+        """
+        batch = C4GameBatch(0, self.history_frames)
+        batch.history = self.history[index]
+        batch.heights = self.heights[index]
+        batch.to_move = self.to_move[index]
+        batch.move_count = self.move_count[index]
+        return batch
+
+    def legal_moves(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        ret: `np.ndarray`
+            A (size, 7) boolean array, True where a column can be played
+        """
+        return self.heights < 6
+
+    def play_moves(self, cols: np.ndarray) -> None:
+        """
+        Parameters
+        ----------
+        cols: `np.ndarray`
+            The column to play in each game. A negative column skips that
+            game, so that finished games can be left as they are
+        Returns
+        -------
+        ret: `None`
+        Raises
+        ------
+        `IndexError`
+            A column is out of range of the columns
+        `ValueError`
+            A column specified is fully occupied
+        """
+        cols = np.asarray(cols, dtype=np.intp)
+        if cols.shape != (len(self),):
+            raise ValueError(f'Expected {len(self)} columns, got {cols.shape}')
+        games = np.nonzero(cols >= 0)[0]
+        cols = cols[games]
+        if (cols >= 7).any():
+            raise IndexError(f'Out of range column {cols.max()}')
+        rows = self.heights[games, cols]
+        if (rows >= 6).any():
+            raise ValueError('Column is fully occupied')
+        if self.history_frames > 1:
+            self.history[games, :-1] = self.history[games, 1:]
+        self.history[games, -1, cols, rows] = self.to_move[games]
+        self.heights[games, cols] += 1
+        self.to_move[games] *= -1
+        self.move_count[games] += 1
+
+    def check_terminal(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        term: `np.ndarray`
+            Per game, 1 if 4 in a row is present on the board else 0 if draw
+            else -1
+        """
+        grids = self.grids
+        win = np.zeros(len(self), dtype=bool)
+        for dc, dr in C4GameBatch.DIRECTIONS:
+            # sum the 4 cells of every line in this direction at once, the
+            # sum is +-4 only if the line is 4 of the same piece
+            r0 = 3 if dr < 0 else 0
+            n_cols = 7 - 3 * dc
+            n_rows = 6 - 3 * abs(dr)
+            total = sum(grids[:, k * dc:k * dc + n_cols,
+                              r0 + k * dr:r0 + k * dr + n_rows]
+                        for k in range(4))
+            win |= (np.abs(total) == 4).any(axis=(1, 2))
+        term = np.where(self.heights.sum(axis=1) == 42, 0, -1)
+        term[win] = 1
+        return term.astype(np.int8)
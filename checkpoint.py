@@ -0,0 +1,180 @@
+"""
+Background checkpointing for the training pipeline. The weights and the
+replay buffer are copied on the training thread, which is quick, and the
+model, the buffer and optionally an ONNX export are written by a writer
+thread. Old checkpoints are deleted, keeping the last few and a milestone
+every so many cycles.
+"""
+import copy
+import os
+import pickle
+import queue
+import re
+import threading
+import time
+
+import keras.backend as K
+from keras.models import Model, clone_model
+
+
+CHECKPOINT_FILE = re.compile(r'save_(\d+)\.ntwk$')
+
+
+class CheckpointWriter:
+    """
+    Writes `save_{cycle}.ntwk` checkpoints (and `save_{cycle}.onnx`) and
+    `data_buffer.dbuf` into a directory, on its own thread. The optimizer's
+    state, such as the SGD momentum, is snapshotted with the weights, so a
+    checkpoint resumes training where it left off
+    """
+
+    def __init__(self, model: Model, save_path: str, every: int = 1,
+                 every_seconds: float = None, keep_last: int = 5,
+                 milestone_every: int = 100, export_onnx: bool = False,
+                 max_pending: int = 2) -> None:
+        """
+        Parameters
+        ----------
+        model: `keras.models.Model`
+            The model being trained
+        save_path: `str`
+            The directory to write to
+        every: `int`
+            Defaults to 1. Save every this many cycles, 0 for never
+        every_seconds: `float`
+            Defaults to None. Also save when this long has passed since the
+            last save
+        keep_last: `int`
+            Defaults to 5. The number of latest checkpoints kept
+        milestone_every: `int`
+            Defaults to 100. Checkpoints of cycles divisible by this are never
+            deleted, 0 for none
+        export_onnx: `bool`
+            Defaults to False. Also export each checkpoint to ONNX
+        max_pending: `int`
+            Defaults to 2. Saves queued beyond this make the training thread
+            wait for the writer
+        """
+        self.model = model
+        self.save_path = save_path
+        self.every = every
+        self.every_seconds = every_seconds
+        self.keep_last = keep_last
+        self.milestone_every = milestone_every
+        self.export_onnx = export_onnx
+        # the model written out, so training carries on with the real one.
+        # it is made here, as the graph is only the default on this thread
+        self.session = K.get_session()
+        self.graph = self.session.graph
+        self.shadow = clone_model(model)
+        self.shadow.compile(
+            model.optimizer.__class__.from_config(
+                model.optimizer.get_config()),
+            loss=model.loss, loss_weights=model.loss_weights)
+        # makes the shadow optimizer's variables, to copy the state into
+        self.shadow._make_train_function()
+        # checkpoints of earlier runs are subject to the retention too
+        self.saved = sorted(
+            int(m.group(1)) for m in map(CHECKPOINT_FILE.match,
+                                         os.listdir(save_path)) if m)
+        self.last_save = time.time()
+        self.error = None
+        self.jobs = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def due(self, cycle: int) -> bool:
+        if self.every and not cycle % self.every:
+            return True
+        return (self.every_seconds is not None and
+                time.time() - self.last_save >= self.every_seconds)
+
+    def maybe_save(self, cycle: int, buffer=None) -> bool:
+        """
+        Saves if `due`. See `save`
+        Returns
+        -------
+        saved: `bool`
+            True if a save was queued
+        """
+        if not self.due(cycle):
+            return False
+        self.save(cycle, buffer)
+        return True
+
+    def save(self, cycle: int, buffer=None) -> None:
+        """
+        Snapshots the weights and optimizer state, and `buffer` if given,
+        and queues them to be written
+        Parameters
+        ----------
+        cycle: `int`
+            The training cycle, which names the checkpoint
+        buffer:
+            Defaults to None. The replay buffer, which is copied shallowly
+        Raises
+        ------
+        `RuntimeError`
+            An earlier write failed
+        """
+        if self.error is not None:
+            raise RuntimeError('Checkpoint writer failed') from self.error
+        self.last_save = time.time()
+        self.jobs.put((cycle, self.model.get_weights(),
+                       self.model.optimizer.get_weights(),
+                       copy.copy(buffer) if buffer is not None else None))
+
+    def close(self) -> None:
+        """
+        Writes the queued saves, then stops the writer
+        """
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                self._write(*job)
+            except Exception as e:
+                print(f'Checkpoint of cycle {job[0]} failed: {e}')
+                self.error = e
+
+    def _write(self, cycle: int, weights: list, optimizer_weights: list,
+               buffer) -> None:
+        path = os.path.join(self.save_path, f'save_{cycle}')
+        with self.graph.as_default(), self.session.as_default():
+            self.shadow.set_weights(weights)
+            # empty until the model has been trained
+            if optimizer_weights:
+                self.shadow.optimizer.set_weights(optimizer_weights)
+            self.shadow.save(path + '.ntwk.tmp')
+            os.replace(path + '.ntwk.tmp', path + '.ntwk')
+            if self.export_onnx:
+                from onnx_converter import save as save_as_onnx
+
+                save_as_onnx(self.shadow, path + '.onnx')
+        if buffer is not None:
+            buffer_file = os.path.join(self.save_path, 'data_buffer.dbuf')
+            with open(buffer_file + '.tmp', 'wb') as f:
+                pickle.dump(buffer, f)
+            os.replace(buffer_file + '.tmp', buffer_file)
+        if cycle not in self.saved:
+            self.saved.append(cycle)
+        self._prune()
+
+    def _prune(self) -> None:
+        recent = set(self.saved[-self.keep_last:]) if self.keep_last else set()
+        every = self.milestone_every
+        kept = []
+        for cycle in self.saved:
+            if (every and not cycle % every) or cycle in recent:
+                kept.append(cycle)
+                continue
+            for ext in ('.ntwk', '.onnx'):
+                path = os.path.join(self.save_path, f'save_{cycle}{ext}')
+                if os.path.exists(path):
+                    os.remove(path)
+        self.saved = kept
@@ -0,0 +1,556 @@
+"""
+Distributed selfplay over TCP. The trainer runs a `Coordinator`, which
+serves the latest model and selfplay settings and collects the games sent
+back. Workers, on any number of hosts, pull the model whenever it changes,
+play games with either selfplay backend and push them back in batches.
+Every message is a length-prefixed frame of a JSON header and a binary
+payload; models travel as keras model files and games as compressed numpy
+archives. Games are loaded without pickle, so the coordinator can take
+them from any worker, and are checked against the published model before
+they reach the trainer. The coordinator listens on localhost unless given
+a host; when it listens on a network, give it and its workers a shared
+token, which they present on connecting. A keras model file can run code
+when loaded (Lambda layers), so workers must only connect to a coordinator
+they trust.
+Workers on the engine backend keep their engine processes between pushes
+and reload them only when the model version changes.
+Usage:
+    python distributed.py worker HOST [--port P] [--backend python|engine]
+                                      [--token T]
+    python distributed.py local MODEL_FILE [--workers W] [--games G]
+"""
+import argparse
+import hmac
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+from keras.models import Model
+
+
+PORT = 8422
+# json length, payload length
+HEADER = struct.Struct('>II')
+MAX_FRAME = 1 << 28
+
+# (states, result, moves, visits), as the selfplay generators yield them
+Game = Tuple[np.ndarray, int, List[int], np.ndarray]
+
+
+def recv_exact(sock: socket.socket, n: int) -> bytes:
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_frame(sock: socket.socket, header: dict,
+               payload: bytes = b'') -> None:
+    data = json.dumps(header).encode()
+    sock.sendall(HEADER.pack(len(data), len(payload)) + data + payload)
+
+
+def recv_frame(sock: socket.socket) -> Tuple[dict, bytes]:
+    """
+    Returns
+    -------
+    header: `dict`
+        The JSON header
+    payload: `bytes`
+        The binary payload, which may be empty
+    Raises
+    ------
+    `ConnectionError`
+        The connection closed, or the frame is larger than `MAX_FRAME`
+    """
+    header_len, payload_len = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if header_len + payload_len > MAX_FRAME:
+        raise ConnectionError('Frame too large')
+    header = json.loads(recv_exact(sock, header_len).decode())
+    return header, recv_exact(sock, payload_len)
+
+
+def _concatenate(arrays: list, dtype) -> np.ndarray:
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate([np.asarray(a, dtype=dtype) for a in arrays])
+
+
+def encode_games(games: List[Game]) -> bytes:
+    """
+    Packs games, possibly none, into one compressed numpy archive
+    """
+    lengths = [len(g[2]) for g in games]
+    buf = io.BytesIO()
+    np.savez_compressed(
+        buf,
+        lengths=np.array(lengths, dtype=np.int32),
+        results=np.array([g[1] for g in games], dtype=np.int8),
+        states=_concatenate([g[0] for g in games], np.float32),
+        moves=_concatenate([g[2] for g in games], np.int8),
+        visits=_concatenate([g[3] for g in games], np.float32))
+    return buf.getvalue()
+
+
+def decode_games(data: bytes, state_shape: tuple = None) -> List[Game]:
+    """
+    The reverse of `encode_games`
+    Parameters
+    ----------
+    data: `bytes`
+        The archive
+    state_shape: `tuple`
+        Defaults to None. The shape every state must have, that of the
+        model's input without the batch axis. None skips the check
+    Raises
+    ------
+    `ValueError`
+        The data is not a valid archive of games
+    """
+    with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+        lengths = archive['lengths']
+        results = archive['results']
+        states = archive['states']
+        moves = archive['moves']
+        visits = archive['visits']
+    for array in (lengths, results, moves):
+        if array.ndim != 1 or array.dtype.kind not in 'iu':
+            raise ValueError('Game archive fields have the wrong type')
+    if not len(lengths):
+        return []
+    if (lengths < 0).any():
+        raise ValueError('Negative game length')
+    ends = np.cumsum(lengths)
+    if (len(results) != len(lengths) or len(states) != ends[-1] or
+            len(moves) != ends[-1] or len(visits) != ends[-1]):
+        raise ValueError('Inconsistent game archive')
+    if state_shape is not None and states.shape[1:] != tuple(state_shape):
+        raise ValueError(f'States of shape {states.shape[1:]}, expected '
+                         f'{tuple(state_shape)}')
+    if visits.ndim != 2 or visits.shape[1] != 7:
+        raise ValueError(f'Visits of shape {visits.shape[1:]}, expected '
+                         f'(7,)')
+    if not (np.isfinite(states).all() and np.isfinite(visits).all()):
+        raise ValueError('States or visits are not finite')
+    if ((moves < 0) | (moves > 6)).any():
+        raise ValueError('Move outside the board')
+    if not np.isin(results, (-1, 0, 1)).all():
+        raise ValueError('Result other than -1, 0 or 1')
+    games = []
+    for result, end, length in zip(results, ends, lengths):
+        start = end - length
+        games.append((states[start:end], int(result),
+                      moves[start:end].tolist(), visits[start:end]))
+    return games
+
+
+def model_to_bytes(model: Model) -> bytes:
+    fd, path = tempfile.mkstemp(suffix='.ntwk')
+    os.close(fd)
+    try:
+        model.save(path)
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+def model_from_bytes(data: bytes) -> Model:
+    from keras.models import load_model
+
+    fd, path = tempfile.mkstemp(suffix='.ntwk')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return load_model(path)
+    finally:
+        os.remove(path)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Coordinator:
+    """
+    Serves the model to workers and collects their games, on a thread of
+    its own
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = PORT,
+                 max_games: int = 1000, token: str = None) -> None:
+        """
+        Parameters
+        ----------
+        host, port:
+            The address to listen on. The host defaults to localhost; use
+            '0.0.0.0' for workers on other hosts, with a `token`
+        max_games: `int`
+            Defaults to 1000. Games held until collected. Workers pushing
+            beyond this wait until the trainer catches up
+        token: `str`
+            Defaults to None, for none. A shared secret workers must give
+            on connecting before they are served
+        """
+        self.version = 0  # 0 until a model is published
+        self.model_data = b''
+        self.settings = {}
+        self.state_shape = None
+        self.token = token
+        self.games = queue.Queue(max_games)
+        self.lock = threading.Lock()
+        self.received = 0
+        self.workers: Dict[str, dict] = {}
+        coordinator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self) -> None:
+                coordinator._serve(self.request, self.client_address)
+
+        self.server = _Server((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def publish(self, model: Model, **settings) -> int:
+        """
+        Makes `model` the one workers play with
+        Parameters
+        ----------
+        model: `keras.models.Model`
+            The model
+        settings:
+            Keyword arguments for the workers' `do_selfplay`: playouts,
+            c_puct, dir_alpha, temp_cutoff and mcts_batch_size
+        Returns
+        -------
+        version: `int`
+            The version number of the model
+        """
+        data = model_to_bytes(model)
+        with self.lock:
+            self.version += 1
+            self.model_data = data
+            self.settings = settings
+            self.state_shape = tuple(model.input_shape[1:])
+            return self.version
+
+    def collect(self, num: int, timeout: float = None) -> Iterator[Game]:
+        """
+        Yields `num` games as they arrive, in the form of `do_selfplay`
+        Raises
+        ------
+        `queue.Empty`
+            No game arrived within `timeout` seconds
+        """
+        for _ in range(num):
+            yield self.games.get(timeout=timeout)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'version': self.version, 'received': self.received,
+                    'waiting': self.games.qsize(),
+                    'workers': {k: dict(v) for k, v in self.workers.items()}}
+
+    def _serve(self, sock: socket.socket, address) -> None:
+        name = f'{address[0]}:{address[1]}'
+        trusted = self.token is None
+        try:
+            while True:
+                request, payload = recv_frame(sock)
+                if request.get('op') == 'hello':
+                    token = str(request.get('token', ''))
+                    if self.token is not None and not hmac.compare_digest(
+                            token.encode(), self.token.encode()):
+                        send_frame(sock, {'error': 'bad token'})
+                        return
+                    trusted = True
+                    name = str(request.get('name', name))
+                    send_frame(sock, {'ok': True})
+                elif not trusted:
+                    send_frame(sock, {'error': 'hello first'})
+                    return
+                elif request.get('op') == 'model':
+                    with self.lock:
+                        version = self.version
+                        data = self.model_data
+                        settings = self.settings
+                    if request.get('have') == version:
+                        data = b''
+                    send_frame(sock, {'version': version,
+                                      'settings': settings}, data)
+                elif request.get('op') == 'games':
+                    with self.lock:
+                        state_shape = self.state_shape
+                    try:
+                        games = decode_games(payload, state_shape)
+                    except (ValueError, KeyError, OSError) as e:
+                        send_frame(sock, {'error': f'bad games: {e}'})
+                        continue
+                    for game in games:
+                        self.games.put(game)
+                    with self.lock:
+                        self.received += len(games)
+                        worker = self.workers.setdefault(name, {'games': 0})
+                        worker['games'] += len(games)
+                        worker['version'] = request.get('version')
+                        worker['seen'] = time.time()
+                    send_frame(sock, {'accepted': len(games)})
+                else:
+                    send_frame(sock, {'error': 'unknown op'})
+        except (ConnectionError, OSError):
+            return
+
+
+class Worker:
+    """
+    Plays selfplay games for a `Coordinator`
+    """
+
+    def __init__(self, host: str, port: int = PORT, backend: str = 'python',
+                 games_per_push: int = 2, name: str = None,
+                 token: str = None) -> None:
+        """
+        Parameters
+        ----------
+        host, port:
+            The coordinator's address
+        backend: `str`
+            Defaults to 'python'. 'python' plays with selfplay.py, 'engine'
+            with the native engines of selfplay_v2.py
+        games_per_push: `int`
+            Defaults to 2. Games played per model check and push
+        name: `str`
+            Defaults to None, for the host name and process id
+        token: `str`
+            Defaults to None. The coordinator's shared token, if it has one
+        """
+        self.host = host
+        self.port = port
+        self.backend = backend
+        self.games_per_push = games_per_push
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self.token = token
+        self.sock = None
+        self.version = 0
+        self.model = None
+        self.settings = {}
+        self.pool = None  # the engines of the engine backend
+
+    def connect(self) -> None:
+        """
+        Raises
+        ------
+        `PermissionError`
+            The coordinator refused the token
+        """
+        self.sock = socket.create_connection((self.host, self.port))
+        hello = {'op': 'hello', 'name': self.name}
+        if self.token is not None:
+            hello['token'] = self.token
+        reply, _ = self.request(hello)
+        if 'error' in reply:
+            self.sock.close()
+            self.sock = None
+            raise PermissionError(f'Coordinator refused: {reply["error"]}')
+
+    def request(self, header: dict, payload: bytes = b'') -> Tuple[dict,
+                                                                   bytes]:
+        send_frame(self.sock, header, payload)
+        return recv_frame(self.sock)
+
+    def update_model(self) -> bool:
+        """
+        Returns
+        -------
+        ready: `bool`
+            True once there is a model to play with
+        """
+        reply, data = self.request({'op': 'model', 'have': self.version})
+        if data:
+            import keras.backend as K
+
+            # models of earlier versions would pile up in the graph
+            K.clear_session()
+            self.model = model_from_bytes(data)
+            self.settings = reply['settings']
+            if self.backend == 'engine':
+                self.load_engines()
+            # only now, so a model the engines failed to load is fetched
+            # and loaded again
+            self.version = reply['version']
+            print(f'Worker {self.name}: model version {self.version}')
+        return self.model is not None
+
+    def load_engines(self) -> None:
+        """
+        Exports the model for the engines, starting them the first time and
+        reloading them in place after that
+        """
+        import selfplay_v2
+
+        selfplay_v2.save_as_onnx(self.model, selfplay_v2.MODEL_FILE)
+        if self.pool is None:
+            self.pool = selfplay_v2.EnginePool(selfplay_v2.THREADS)
+        else:
+            self.pool.reload()
+
+    def play(self) -> List[Game]:
+        """
+        Raises
+        ------
+        `RuntimeError`
+            The engines failed to play any game
+        """
+        s = self.settings
+        if self.backend == 'engine':
+            from selfplay_v2 import play_games
+
+            if len(self.pool.engines) < self.pool.size:
+                # restart the engines which failed and could not be replaced
+                self.pool.reload()
+            games = play_games(self.pool, self.games_per_push,
+                               s['playouts'], s['c_puct'], s['dir_alpha'],
+                               s['temp_cutoff'])
+            if not games:
+                raise RuntimeError('Every selfplay game failed')
+            return games
+        from selfplay import do_selfplay
+
+        return list(do_selfplay(self.games_per_push, s['playouts'],
+                                s['c_puct'], self.model, s['dir_alpha'],
+                                s['temp_cutoff'], s['mcts_batch_size']))
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def run(self, max_games: int = None) -> None:
+        """
+        Plays and pushes games until `max_games`, or forever, reconnecting
+        whenever the connection is lost. A batch whose engines failed is
+        dropped. The worker is closed on return
+        Raises
+        ------
+        `PermissionError`
+            The coordinator refused the token
+        """
+        played = 0
+        try:
+            while max_games is None or played < max_games:
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    if not self.update_model():
+                        time.sleep(1)
+                        continue
+                    games = self.play()
+                    reply, _ = self.request(
+                        {'op': 'games', 'version': self.version},
+                        encode_games(games))
+                    if 'error' in reply:
+                        print(f'Worker {self.name}: {reply["error"]}')
+                    played += reply.get('accepted', 0)
+                except PermissionError:
+                    raise
+                except RuntimeError as e:
+                    # the engines failed, the connection is still good
+                    print(f'Worker {self.name}: {e}, batch dropped')
+                    time.sleep(2)
+                except (ConnectionError, OSError) as e:
+                    print(f'Worker {self.name}: {e}, reconnecting')
+                    if self.sock is not None:
+                        self.sock.close()
+                    self.sock = None
+                    time.sleep(2)
+        finally:
+            self.close()
+
+
+def spawn_workers(host: str, port: int, count: int,
+                  backend: str = 'python') -> List[subprocess.Popen]:
+    """
+    Starts `count` worker processes of this file
+    """
+    return [subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              'worker', host, '--port', str(port),
+                              '--backend', backend])
+            for _ in range(count)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Distributed selfplay')
+    commands = parser.add_subparsers(dest='command')
+    worker = commands.add_parser('worker', help='play games for a trainer')
+    worker.add_argument('host')
+    worker.add_argument('--port', type=int, default=PORT)
+    worker.add_argument('--backend', choices=('python', 'engine'),
+                        default='python')
+    worker.add_argument('--games-per-push', type=int, default=2)
+    worker.add_argument('--token', help="the coordinator's shared token")
+    local = commands.add_parser(
+        'local', help='collect games from worker processes on this host')
+    local.add_argument('model', help='keras model file')
+    local.add_argument('--workers', type=int, default=2)
+    local.add_argument('--games', type=int, default=8)
+    local.add_argument('--playouts', type=int, default=200)
+    local.add_argument('--port', type=int, default=PORT)
+    local.add_argument('--backend', choices=('python', 'engine'),
+                       default='python')
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        Worker(args.host, args.port, args.backend,
+               args.games_per_push, token=args.token).run()
+    elif args.command == 'local':
+        from keras.models import load_model
+
+        coordinator = Coordinator('127.0.0.1', args.port)
+        coordinator.publish(load_model(args.model), playouts=args.playouts,
+                            c_puct=3, dir_alpha=0.8, temp_cutoff=12,
+                            mcts_batch_size=10)
+        workers = spawn_workers('127.0.0.1', coordinator.port, args.workers,
+                                args.backend)
+        start = time.time()
+        try:
+            for i, game in enumerate(coordinator.collect(args.games)):
+                print(f'Game {i + 1}/{args.games}: {len(game[2])} moves, '
+                      f'result {game[1]}')
+            elapsed = time.time() - start
+            print(f'{args.games / elapsed:.2f} games/s')
+            print(json.dumps(coordinator.stats(), indent=2))
+        finally:
+            for w in workers:
+                w.terminate()
+            coordinator.close()
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
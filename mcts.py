@@ -177,7 +177,8 @@ class MCTS:
     """
 
     def __init__(self, position: C4Game, stochastic: bool, network: Model,
-                 c_puct: float, playouts: int, dir_alpha: float = 1.4):
+                 c_puct: float, playouts: int, dir_alpha: float = 1.4,
+                 rng: np.random.Generator = None):
         """
         Parameters
         ----------
@@ -193,6 +194,10 @@ class MCTS:
             Number of playouts to make for search
         dir_alpha: `float`
             Diriclet alpha for selfplay training games, defaults to 1.4
+        rng: `np.random.Generator`
+            Defaults to None. The random generator for the Dirichlet noise
+            and move selection in selfplay games. Seed it for reproducible
+            games
         """
         # team is -1 for black to play, 1 for white to play
         self.top_node = MCTSNode()
@@ -202,6 +207,7 @@ class MCTS:
         self.playouts = playouts
         self.stochastic = stochastic
         self.dir_alpha = dir_alpha
+        self.rng = rng if rng is not None else np.random.default_rng()
 
     def playout_to_max(self, dir_alpha: float = 1.4) -> np.ndarray:
         """
@@ -231,15 +237,10 @@ class MCTS:
             # expand, but before that, add dirichlet noise
             # dirichlet noise for legal moves only
             if self.stochastic:  # we are doing a selfplay game
-                legal_moves = look_position.legal_moves()
-                _dirichlet = np.random.dirichlet(
-                    [self.dir_alpha] * sum(legal_moves))
+                legal_moves = np.array(look_position.legal_moves(), dtype=bool)
                 dirichlet = np.zeros(7)
-                ind = 0
-                for i, v in enumerate(legal_moves):
-                    if v:
-                        dirichlet[i] = _dirichlet[ind]
-                        ind += 1
+                dirichlet[legal_moves] = self.rng.dirichlet(
+                    [self.dir_alpha] * legal_moves.sum())
                 leaf.expand((priors[0] + dirichlet) * 0.5, look_position)
             else:
                 leaf.expand(priors[0], look_position)
@@ -292,7 +293,8 @@ class MCTS:
         # v ^ (1 / temp) = exp(log(v ^ (1 / temp))) = exp(log(v) / temp)
         new_probs = softmax(np.log(np.array(visits) + 1e-10) / temp)
         # give this a try
-        return np.random.choice(self.top_node.children, 1, p=new_probs)[0].move
+        index = self.rng.choice(len(new_probs), p=new_probs)
+        return self.top_node.children[index].move
 
     def get_pv(self) -> List[MCTSNode]:
         """
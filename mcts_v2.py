@@ -13,9 +13,10 @@ The main differences:
         nodes without any visits will return a default Q value of -1, assuming
         that the move is losing
 """
-import random
+import math
 import time
-from typing import List
+from array import array
+from typing import List, Tuple
 
 import numpy as np
 from keras.models import Model
@@ -25,6 +26,10 @@ from c4game import C4Game
 
 USE_ITERATIVE_FOR_GREEDY_TRAVERSAL = False
 DO_SEARCH_TREE_PRUNING = False
+# bytes held by one node with its share of the packed child arrays, for
+# budgeting the tree by memory. Measured with tracemalloc over 20000
+# playouts from the empty board, without the evaluation cache
+NODE_BYTES = 420
 
 
 def softmax(x):
@@ -44,14 +49,64 @@ def l1_exp(x):
     return probs
 
 
+def select_moves(visits: np.ndarray, temps, rng: np.random.Generator,
+                 dir_alpha: float = None, noise: float = 0.16,
+                 legal: np.ndarray = None) -> np.ndarray:
+    """
+    Picks a move for each row of `visits`. `MCTS.pick_move` passes the one
+    row of its own game
+    Parameters
+    ----------
+    visits: `np.ndarray`
+        Root visit counts (or visit shares) of shape (games, 7)
+    temps: `float` or `np.ndarray`
+        The temperature for all games, or one per game
+    rng: `np.random.Generator`
+        The random generator, seed it for reproducible games
+    dir_alpha: `float`
+        Defaults to None. If given, Dirichlet noise with this alpha is mixed
+        into the visit shares over the legal moves
+    noise: `float`
+        Defaults to 0.16. The share of Dirichlet noise
+    legal: `np.ndarray`
+        Boolean mask of shape (games, 7). Defaults to the moves with visits
+    Returns
+    -------
+    moves: `np.ndarray`
+        The column picked in every game
+    """
+    visits = np.asarray(visits, dtype=float)
+    if legal is None:
+        legal = visits > 0
+    probs = visits / visits.sum(axis=1, keepdims=True)
+    if dir_alpha:
+        # Dirichlet samples are normalised gamma samples
+        gamma = rng.standard_gamma(dir_alpha, size=probs.shape) * legal
+        probs = (probs * (1 - noise) +
+                 gamma / gamma.sum(axis=1, keepdims=True) * noise)
+    # normally we would
+    # let v = a vector of visits
+    # v ^ (1 / temp)
+    # but due to overflow problems, we rearrange
+    # v ^ (1 / temp) = exp(log(v ^ (1 / temp))) = exp(log(v) / temp)
+    temps = np.broadcast_to(np.asarray(temps, dtype=float), (len(probs),))
+    logits = np.log(probs + 1e-10) / temps[:, None]
+    logits[~legal] = float('-inf')  # only legal moves may be picked
+    # the argmax of logits plus gumbel noise is a sample of softmax(logits)
+    return np.argmax(logits + rng.gumbel(size=logits.shape), axis=1)
+
+
 class MCTSNode:
     """
     A node of MCTS tree
+    Expanded nodes only keep their legal moves and a packed array of priors.
+    A child node is materialised the first time it is selected; until then
+    it has no visits and its statistics are implied
     """
 
     # memory efficiency and performance
-    __slots__ = ('move', 'parent', 'children', 'prune', 'terminal',
-                 'terminal_score', 'P', 'N', 'W', 'VL')
+    __slots__ = ('move', 'parent', 'kids', 'moves', 'priors', 'prune',
+                 'terminal', 'terminal_score', 'P', 'N', 'W', 'VL')
 
     def __init__(self, parent: "MCTSNode" = None,
                  move: int = None, prior: float = None,
@@ -72,7 +127,10 @@ class MCTSNode:
         """
         self.move = move
         self.parent = parent
-        self.children: List[MCTSNode] = []
+        # set on expansion, all aligned with each other
+        self.moves: bytes = None  # legal moves
+        self.priors: array = None  # prior of each legal move
+        self.kids: List[MCTSNode] = None  # None until materialised
         self.prune = False  # set to true if it is a losing move
         self.terminal = terminal  # denotes the winner of the game.
         self.terminal_score = terminal_score  # 1 if win, 0 if tie
@@ -81,6 +139,22 @@ class MCTSNode:
         self.W = 0  # cumulative of value backpropagation; default value
         self.VL = 0  # virtual loss; default value
 
+    @property
+    def expanded(self) -> bool:
+        return self.moves is not None
+
+    @property
+    def children(self) -> List['MCTSNode']:
+        """
+        Returns
+        -------
+        children: `List[MCTSNode]`
+            The children which have been materialised so far
+        """
+        if self.kids is None:
+            return []
+        return [c for c in self.kids if c is not None]
+
     @property
     def Q(self) -> int:
         if self.prune:
@@ -114,6 +188,65 @@ class MCTSNode:
              (1 + self.N))  # + self.VL?
         return self.Q + u
 
+    def select(self, c_puct: float) -> Tuple[int, float]:
+        """
+        Finds the best child for greedy selection, as per `value`. Children
+        which have not been materialised have no visits, so they score with
+        the FPU value
+        Parameters
+        ----------
+        c_puct: `float`
+            Constant controlling exploration
+        Returns
+        -------
+        index: `int`
+            The index of the best child into `moves`
+        score: `float`
+            The score of the best child
+        """
+        # the parent dependent part of the 'U' term is shared by all children
+        scale = ((math.log((self.N + 19652 + 1) / 19652) + c_puct) *
+                 self.N ** 0.5)
+        priors = self.priors
+        # more performant than np.argmax by a lot
+        max_child_score = float('-inf')
+        max_child_index = 0
+        for i, c in enumerate(self.kids):
+            if c is None:
+                v = scale * priors[i] - 1  # FPU in alphazero is -1
+            elif c.terminal and c.terminal_score:  # win
+                v = float('inf')
+            else:
+                v = c.Q + scale * c.P / (1 + c.N)
+            if v > max_child_score:
+                max_child_score = v
+                max_child_index = i
+        return max_child_index, max_child_score
+
+    def materialize(self, index: int, term: int,
+                    pool: 'NodePool' = None) -> 'MCTSNode':
+        """
+        Creates the child node for `moves[index]`
+        Parameters
+        ----------
+        index: `int`
+            The index of the child into `moves`
+        term: `int`
+            The result of `C4Game.check_terminal` after the child's move
+        pool: `NodePool`
+            The pool to take the child from. If no pool is given, a new node
+            is made
+        Returns
+        -------
+        child: `MCTSNode`
+            The new child
+        """
+        args = (self, self.moves[index], self.priors[index],
+                term is not None, term if term is not None else 0)
+        child = pool.create(*args) if pool is not None else MCTSNode(*args)
+        self.kids[index] = child
+        return child
+
     def backprop(self, value: float) -> None:
         """
         Backproagates a value from leaf node to top node
@@ -132,7 +265,8 @@ class MCTSNode:
         if self.parent:  # is not None
             self.parent.backprop(-value)
 
-    def to_leaf(self, c_puct: float, position: C4Game) -> 'MCTSNode':
+    def to_leaf(self, c_puct: float, position: C4Game,
+                pool: 'NodePool' = None) -> 'MCTSNode':
         """
         Traverses the tree from current node to a leaf node
         Parameters
@@ -142,6 +276,10 @@ class MCTSNode:
         position: `C4Game`
             The position of the current game state, which will be automatically
             updated as the tree is traversed to a leaf node.
+        pool: `NodePool`
+            The pool new children are taken from. If the pool is full, the
+            deepest expanded node reached is returned as the leaf, and
+            `evaluate_leaves` backs up its mean value again
         Returns
         -------
         leaf_node: `MCTSNode`
@@ -153,26 +291,23 @@ class MCTSNode:
                 curr.VL += 1
                 if curr.move is not None:
                     position.play_move(curr.move)
-                if not curr.children or curr.terminal:
+                if curr.kids is None or curr.terminal:
                     return curr
-                child_scores = [c.value(c_puct) for c in curr.children]
-                curr = curr.children[child_scores.index(max(child_scores))]
+                i, _ = curr.select(c_puct)
+                if curr.kids[i] is None:
+                    if pool is not None and not pool.has_room():
+                        return curr
+                    return curr.materialize_leaf(i, position, pool)
+                curr = curr.kids[i]
             raise Exception("Tree traversal error")
         # BELOW: RECURSIVE ALGORITHM
         self.VL += 1
         if self.move is not None:
             position.play_move(self.move)
-        if not self.children:
+        if self.kids is None:
             return self
-        # more performant than np.argmax by a lot
         # select the best child
-        max_child_score = float('-inf')
-        max_child_index = 0
-        for i, c in enumerate(self.children):
-            v = c.value(c_puct)
-            if v > max_child_score:
-                max_child_score = v
-                max_child_index = i
+        max_child_index, max_child_score = self.select(c_puct)
         if DO_SEARCH_TREE_PRUNING:
             if max_child_score < -1:  # all losing, this move is won
                 self.terminal = True
@@ -180,29 +315,75 @@ class MCTSNode:
                 return self
             elif max_child_score == float('inf'):  # this move is lost
                 self.prune = True  # this node will never be selected again
-        return (self.children[max_child_index].to_leaf(c_puct, position))
+        child = self.kids[max_child_index]
+        if child is None:
+            if pool is not None and not pool.has_room():
+                return self  # tree is full, search this node again
+            return self.materialize_leaf(max_child_index, position, pool)
+        return child.to_leaf(c_puct, position, pool)
+
+    def materialize_leaf(self, index: int, position: C4Game,
+                         pool: 'NodePool' = None) -> 'MCTSNode':
+        """
+        Materialises a child which was just selected, completing `to_leaf`
+        on it. A new child has no children, so it is always the leaf
+        Parameters
+        ----------
+        index: `int`
+            The index of the child into `moves`
+        position: `C4Game`
+            The position of this node, which will have the child's move played
+        pool: `NodePool`
+            The pool to take the child from
+        Returns
+        -------
+        leaf_node: `MCTSNode`
+            The new child
+        """
+        position.play_move(self.moves[index])
+        child = self.materialize(index, position.check_terminal(), pool)
+        child.VL += 1
+        return child
 
-    def expand(self, priors: np.ndarray, position: C4Game) -> None:
+    def expand(self, priors: np.ndarray, position: C4Game,
+               pool: 'NodePool' = None) -> None:
         """
-        Adds children to the current node
+        Records the legal moves of the current node and their priors. Child
+        nodes are made when they are first selected in `to_leaf`, except
+        winning moves, which are made at once as terminal so that selection
+        always picks them
         Parameters
         ----------
         priors:
             A vector of the NN's prior probabilities for each child in order
         position:
             The game state required to reach this node
+        pool: `NodePool`
+            The pool winning children are taken from
         """
         allowed = position.legal_moves()
-        for (mv, prior) in enumerate(priors):
-            move = mv
-            if allowed[move]:
-                # empty square
-                position.play_move(move)
-                term = position.check_terminal()
-                is_term = term is not None
-                self.children.append(MCTSNode(self, move, prior, is_term,
-                                              term if term is not None else 0))
-                position.undo_move()
+        self.moves = bytes(mv for mv in range(7) if allowed[mv])
+        self.priors = array('f', (priors[mv] for mv in self.moves))
+        self.kids = [None] * len(self.moves)
+        for mv in position.winning_moves():
+            if pool is not None and not pool.has_room():
+                break  # found when first selected instead
+            self.materialize(self.moves.index(mv), 1, pool)
+
+    def visit_counts(self) -> List[int]:
+        """
+        Returns
+        -------
+        visits: `List[int]`
+            The visits of the child reached by each of the 7 columns, 0 for
+            illegal or unvisited moves
+        """
+        visits = [0] * 7
+        if self.kids is not None:
+            for mv, c in zip(self.moves, self.kids):
+                if c is not None:
+                    visits[mv] = c.N
+        return visits
 
     def walk_pv(self) -> 'MCTSNode':
         """
@@ -226,6 +407,192 @@ class MCTSNode:
         return f'[NODE] MV={self.move} N={self.N} Q={self.Q} P={self.P}'
 
 
+class NodePool:
+    """
+    Keeps count of the nodes of a search tree and recycles the nodes of
+    discarded subtrees, so that the tree can be held to a node budget
+    """
+
+    def __init__(self, max_nodes: int = None, max_free: int = 100000) -> None:
+        """
+        Parameters
+        ----------
+        max_nodes: `int`
+            The node budget. Defaults to None, which is unbounded
+        max_free: `int`
+            The maximum number of released nodes kept around for reuse,
+            defaults to 100000
+        """
+        self.max_nodes = max_nodes
+        self.max_free = max_free
+        self.size = 0  # nodes currently in use
+        self.free: List[MCTSNode] = []
+
+    @classmethod
+    def nodes_for_memory(cls, megabytes: float) -> int:
+        """
+        Parameters
+        ----------
+        megabytes: `float`
+            The amount of memory the tree may use
+        Returns
+        -------
+        max_nodes: `int`
+            The node budget which fits in `megabytes`
+        """
+        return int(megabytes * 1024 * 1024 / NODE_BYTES)
+
+    def has_room(self, n: int = 1) -> bool:
+        """
+        Parameters
+        ----------
+        n: `int`
+            The number of nodes wanted, defaults to 1
+        Returns
+        -------
+        ret: `bool`
+            True if there is room in the budget for `n` more nodes
+        """
+        return self.max_nodes is None or self.size + n <= self.max_nodes
+
+    def create(self, parent: MCTSNode = None, move: int = None,
+               prior: float = None, terminal: bool = False,
+               terminal_score: int = 0) -> MCTSNode:
+        """
+        Takes a node from the pool, arguments as per `MCTSNode`
+        Returns
+        -------
+        node: `MCTSNode`
+            A recycled node if one is available, else a new node
+        """
+        self.size += 1
+        if self.free:
+            node = self.free.pop()
+            node.__init__(parent, move, prior, terminal, terminal_score)
+            return node
+        return MCTSNode(parent, move, prior, terminal, terminal_score)
+
+    def release(self, node: MCTSNode) -> None:
+        """
+        Returns a node and its whole subtree to the pool. References between
+        the released nodes are cleared so none of them outlive the search
+        Parameters
+        ----------
+        node: `MCTSNode`
+            The root of the subtree to release
+        """
+        stack = [node]
+        while stack:
+            curr = stack.pop()
+            stack.extend(curr.children)
+            curr.kids = curr.moves = curr.priors = None
+            curr.parent = None
+            self.size -= 1
+            if len(self.free) < self.max_free:
+                self.free.append(curr)
+
+    def collapse(self, node: MCTSNode) -> None:
+        """
+        Releases the children of a node, turning it back into a leaf. The
+        node keeps its statistics and is expanded again if it is revisited
+        Parameters
+        ----------
+        node: `MCTSNode`
+            The node to collapse
+        """
+        for c in node.children:
+            self.release(c)
+        node.kids = node.moves = node.priors = None
+
+    def trim(self, top_node: MCTSNode, target: int) -> None:
+        """
+        Collapses the least visited subtrees until at most `target` nodes are
+        in use. Must not be called while virtual losses are outstanding
+        Parameters
+        ----------
+        top_node: `MCTSNode`
+            The root of the tree, which is never collapsed
+        target: `int`
+            The number of nodes to trim down to
+        """
+        expanded = []
+        stack = list(top_node.children)
+        while stack:
+            curr = stack.pop()
+            if curr.expanded:
+                expanded.append(curr)
+                stack.extend(curr.children)
+        # descendants never have more visits than their ancestors, so deep
+        # and rarely visited subtrees go first
+        expanded.sort(key=lambda n: n.N)
+        for node in expanded:
+            if self.size <= target:
+                break
+            if node.expanded:  # not already released with an ancestor
+                self.collapse(node)
+
+
+class SearchStats:
+    """
+    Hot path timings and counters of a search. Pass one to `MCTS` to turn
+    instrumentation on; when no stats object is given, nothing is measured
+    """
+
+    STAGES = ('select', 'features', 'predict', 'expand', 'backprop')
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        # cumulative seconds spent in each stage
+        self.time = {stage: 0.0 for stage in SearchStats.STAGES}
+        self.batches = 0
+        self.slots = 0  # leaves collected
+        self.predict_calls = 0
+        self.predicted = 0  # positions sent to the network
+        self.cache_hits = 0
+        self.terminal_hits = 0
+        self.collisions = 0  # a leaf picked more than once in a batch
+        self.stalls = 0  # an expanded node returned, as the tree was full
+        self.depth_sum = 0
+        self.max_depth = 0
+
+    def as_dict(self) -> dict:
+        """
+        Returns
+        -------
+        stats: `dict`
+            Raw counters and timings, plus the derived ratios
+        """
+        slots = max(1, self.slots)
+        return {
+            'time': dict(self.time),
+            'batches': self.batches,
+            'slots': self.slots,
+            'predict_calls': self.predict_calls,
+            'predicted': self.predicted,
+            # share of the collected leaves which needed the network
+            'batch_fill': self.predicted / slots,
+            'cache_hits': self.cache_hits,
+            'terminal_hits': self.terminal_hits,
+            'collisions': self.collisions,
+            'collision_rate': self.collisions / slots,
+            'stalls': self.stalls,
+            'mean_depth': self.depth_sum / slots,
+            'max_depth': self.max_depth,
+        }
+
+    def __str__(self) -> str:
+        stats = self.as_dict()
+        total = sum(self.time.values())
+        ret = '\n'.join(
+            f'{stage} {t:.3f}s {100 * t / total if total else 0:.1f}%'
+            for stage, t in self.time.items())
+        return ret + '\n' + '\n'.join(
+            f'{k} {round(v, 4) if isinstance(v, float) else v}'
+            for k, v in stats.items() if k != 'time')
+
+
 class MCTS:
     """
     MCTS search system
@@ -233,7 +600,11 @@ class MCTS:
 
     def __init__(self, position: C4Game, stochastic: bool, network: Model,
                  c_puct: float, playouts: int, batch_size: int = 16,
-                 dir_alpha: float = 1.4):
+                 dir_alpha: float = 1.4, eval_cache: dict = None,
+                 cache_size: int = 100000, max_nodes: int = None,
+                 trim_when_full: bool = True, stats: SearchStats = None,
+                 adaptive_batch: bool = False,
+                 rng: np.random.Generator = None):
         """
         Parameters
         ----------
@@ -249,9 +620,36 @@ class MCTS:
             Number of playouts to make for search
         dir_alpha: `float`
             Diriclet alpha for selfplay training games, defaults to 1.4
+        eval_cache: `dict`
+            Network evaluations keyed by `C4Game.canonical_key`. Pass the
+            cache of a previous search (e.g. when reusing the tree) to share
+            it. A new cache is made if none is given
+        cache_size: `int`
+            Maximum entries in the evaluation cache before it is cleared,
+            defaults to 100000. Set to 0 to disable caching
+        max_nodes: `int`
+            The most nodes the search tree may hold. Defaults to None, which
+            lets the tree grow without bound. See `NodePool.nodes_for_memory`
+            to budget by memory instead
+        trim_when_full: `bool`
+            Defaults to True. If the tree is full, collapse the least visited
+            subtrees to make room. If False, the search carries on without
+            expanding any more nodes
+        stats: `SearchStats`
+            Defaults to None. If given, search timings and counters are
+            accumulated into it
+        adaptive_batch: `bool`
+            Defaults to False. If True, `batch_size` is only the largest
+            batch; the leaves collected per batch are tuned to the collision
+            rate and to the unique leaves evaluated per second
+        rng: `np.random.Generator`
+            Defaults to None. The random generator for move selection and
+            board flips in selfplay games. Seed it for reproducible games
         """
         # team is -1 for black to play, 1 for white to play
-        self.top_node = MCTSNode()
+        self.pool = NodePool(max_nodes)
+        self.trim_when_full = trim_when_full
+        self.top_node = self.pool.create()
         self.base_position = position  # shallow naming
         self.network = network
         self.c_puct = c_puct
@@ -259,6 +657,20 @@ class MCTS:
         self.stochastic = stochastic
         self.dir_alpha = dir_alpha
         self.batch_size = batch_size  # for parallel-ish
+        # value and policy (in canonical orientation) of evaluated positions
+        # NOTE: keys only cover the current board, which is all the network
+        # sees as long as history_frames is 1
+        self.eval_cache = {} if eval_cache is None else eval_cache
+        self.cache_size = cache_size
+        self.stats = stats
+        self.adaptive_batch = adaptive_batch
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.leaf_batch = batch_size  # leaves collected per batch
+        # batch size tuning state: step, last rate, window of
+        # [batches, unique leaves, seconds]
+        self._batch_step = 1
+        self._last_rate = 0.0
+        self._window = [0, 0, 0.0]
 
     def playout_to_max(self) -> np.ndarray:
         """
@@ -268,68 +680,249 @@ class MCTS:
             A vector of move probabilites following mcts
         """
         while self.top_node.N < self.playouts:
-            # recursively greedily select node via puct algorithm
-            leafs = []  # parallel-ish
-            for _ in range(self.batch_size):
-                look_position = self.base_position.state_copy()
-                leaf = self.top_node.to_leaf(self.c_puct, look_position)
-                leafs.append((leaf, look_position))
-
-            # evaluate
-            evaluations = [None] * self.batch_size
-            batch_priors = [None] * self.batch_size
-            batch_positions = []
-            for i, (leaf, look_position) in enumerate(leafs):
+            if (self.trim_when_full and
+                    not self.pool.has_room(self.batch_size)):
+                # leave some headroom so we do not trim every batch
+                self.pool.trim(self.top_node, int(self.pool.max_nodes * 0.9))
+            if not self.adaptive_batch:
+                leafs = self.collect_leaves(self.batch_size)
+                evaluations, batch_priors = self.evaluate_leaves(leafs)
+                self.apply_evaluations(leafs, evaluations, batch_priors)
+                continue
+            start = time.perf_counter()
+            leafs = self.collect_leaves(self.leaf_batch)
+            evaluations, batch_priors = self.evaluate_leaves(leafs)
+            self.apply_evaluations(leafs, evaluations, batch_priors)
+            self.tune_batch(leafs, time.perf_counter() - start)
+        return self.root_probs()
+
+    def tune_batch(self, leafs: List[Tuple[MCTSNode, C4Game]],
+                   elapsed: float) -> None:
+        """
+        Adjusts `leaf_batch` after a batch. Slots which land on a leaf that
+        is already in the batch are wasted (the position is only evaluated
+        once), so a high collision rate shrinks the batch straight away.
+        Terminal leaves need no evaluation, so as in `collect_leaves` they
+        are never counted as collisions. Otherwise the batch size hill
+        climbs on useful slots per second, which accounts for the inference
+        latency of each size
+        Parameters
+        ----------
+        leafs: `List[Tuple[MCTSNode, C4Game]]`
+            The leaves of the batch
+        elapsed: `float`
+            The seconds the batch took, from collection to backprop
+        """
+        if self.top_node.N < self.batch_size * 4:
+            return  # every slot lands on the first few nodes anyway
+        seen = set()
+        collisions = 0
+        for leaf, _ in leafs:
+            if leaf.terminal:
+                continue
+            if id(leaf) in seen:
+                collisions += 1
+            seen.add(id(leaf))
+        unique = len(leafs) - collisions
+        if collisions > len(leafs) * 0.25:
+            self.leaf_batch = max(1, int(self.leaf_batch * 0.75))
+            self._window = [0, 0, 0.0]
+            return
+        window = self._window
+        window[0] += 1
+        window[1] += unique
+        window[2] += elapsed
+        if window[0] < 4:  # measure each size over a few batches
+            return
+        rate = window[1] / window[2]
+        if rate < self._last_rate * 0.95:  # ignore timing noise
+            self._batch_step = -self._batch_step
+        self._last_rate = rate
+        self.leaf_batch = min(self.batch_size,
+                              max(1, self.leaf_batch + self._batch_step))
+        self._window = [0, 0, 0.0]
+
+    def collect_leaves(self, n: int) -> List[Tuple[MCTSNode, C4Game]]:
+        """
+        Parameters
+        ----------
+        n: `int`
+            The number of leaves to collect. Virtual loss is applied along the
+            path to each leaf until its evaluation is applied
+        Returns
+        -------
+        leafs: `List[Tuple[MCTSNode, C4Game]]`
+            The leaf nodes and their positions
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        # recursively greedily select node via puct algorithm
+        leafs = []  # parallel-ish
+        for _ in range(n):
+            look_position = self.base_position.state_copy()
+            leaf = self.top_node.to_leaf(self.c_puct, look_position,
+                                         self.pool)
+            leafs.append((leaf, look_position))
+        if stats is not None:
+            stats.time['select'] += time.perf_counter() - start
+            stats.batches += 1
+            stats.slots += n
+            seen = set()
+            for leaf, _ in leafs:
                 if leaf.terminal:
-                    evaluations[i] = -abs(leaf.terminal_score)
-                else:
-                    batch_positions.append(look_position.state)
+                    stats.terminal_hits += 1
+                elif leaf.expanded:
+                    stats.stalls += 1
+                elif id(leaf) in seen:
+                    stats.collisions += 1
+                seen.add(id(leaf))
+                depth = 0
+                while leaf is not self.top_node and leaf is not None:
+                    leaf = leaf.parent
+                    depth += 1
+                stats.depth_sum += depth
+                stats.max_depth = max(stats.max_depth, depth)
+        return leafs
+
+    def evaluate_leaves(self, leafs: List[Tuple[MCTSNode, C4Game]]
+                        ) -> Tuple[list, list]:
+        """
+        Evaluates leaves from the cache, terminal scores and the network. The
+        tree is not changed, but the evaluation cache and stats are, so with
+        several searching threads it must run under their lock (see
+        `parallel_search.TreeParallelMCTS`)
+        Parameters
+        ----------
+        leafs: `List[Tuple[MCTSNode, C4Game]]`
+            Leaves as returned by `collect_leaves`
+        Returns
+        -------
+        evaluations: `list`
+            The value of each leaf for the player to move in it
+        batch_priors: `list`
+            The policy of each leaf, None for terminal leaves
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        evaluations = [None] * len(leafs)
+        batch_priors = [None] * len(leafs)
+        batch_positions = []
+        # canonical key -> (index into batch_positions, batch slots)
+        pending = {}
+        for i, (leaf, look_position) in enumerate(leafs):
+            if leaf.terminal:
+                evaluations[i] = -abs(leaf.terminal_score)
+                continue
+            if leaf.expanded and leaf.N:
+                # the tree is full, so selection stopped at an expanded
+                # node. Its mean value is backed up again, without the
+                # network, which leaves the node's own Q unchanged
+                evaluations[i] = -leaf.W / leaf.N
+                continue
+            key, mirrored = look_position.canonical_key()
+            cached = self.eval_cache.get(key)
+            if cached is not None:
+                evaluations[i] = cached[0]
+                batch_priors[i] = (cached[1][::-1] if mirrored
+                                   else cached[1])
+                continue
+            # a transposition or mirror of a position already in the batch
+            # is only sent to the network once
+            if key not in pending:
+                pending[key] = (len(batch_positions), [])
+                batch_positions.append(look_position.state)
+            pending[key][1].append((i, mirrored))
 
-            # use the neural network
+        # use the neural network
+        if batch_positions:
+            batch_positions = np.array(batch_positions)
             # 50% chance to flip every position in the batch in training
-            flipped = False
-            if self.stochastic and random.random() > 0.5:
-                flipped = True
+            flipped = self.stochastic and self.rng.random() > 0.5
+            if flipped:
                 batch_positions = batch_positions[:, ::-1, :, :]
-            if batch_positions:
-                leaf_value, priors = self.network.predict(
-                    np.array(batch_positions))
-                if flipped:
-                    priors = priors[:, ::-1]
-            else:
-                leaf_value, priors = [], []
-            # populate evaluations
-            _count = 0
-            for i, ev in enumerate(evaluations):
-                if ev is None:
-                    evaluations[i] = leaf_value[_count, 0]
-                    # if we needed an evaluation we also need an expansion
-                    batch_priors[i] = priors[_count]
-                    _count += 1
-            # leaf_value is how good it is for CURRENT player of the state
-            for (leaf, look_position), prior in zip(leafs, batch_priors):
-                # we could have 2 or more searches on one leaf
-                if not leaf.children and not leaf.terminal:
-                    leaf.expand(prior, look_position)
-            # backprop
-            for (leaf, _), ev in zip(leafs, evaluations):
-                leaf.backprop(-ev)
+            if stats is not None:
+                predict_start = time.perf_counter()
+                stats.time['features'] += predict_start - start
+            leaf_value, priors = self.network.predict(batch_positions)
+            if stats is not None:
+                start = time.perf_counter()
+                stats.time['predict'] += start - predict_start
+                stats.predict_calls += 1
+                stats.predicted += len(batch_positions)
+            if flipped:
+                priors = priors[:, ::-1]
+        # populate evaluations
+        for key, (ind, slots) in pending.items():
+            value = leaf_value[ind, 0]
+            prior = priors[ind]
+            # the evaluated position is the one of the first slot
+            evaluated_mirrored = slots[0][1]
+            for i, mirrored in slots:
+                evaluations[i] = value
+                # if we needed an evaluation we also need an expansion
+                batch_priors[i] = (prior[::-1] if mirrored !=
+                                   evaluated_mirrored else prior)
+            # store in canonical orientation
+            if self.cache_size:
+                if len(self.eval_cache) >= self.cache_size:
+                    self.eval_cache.clear()
+                self.eval_cache[key] = (
+                    value, prior[::-1] if evaluated_mirrored else prior)
+        if stats is not None:
+            stats.time['features'] += time.perf_counter() - start
+            # leaves which were neither terminal, stalled nor sent to the
+            # network
+            evaluated = sum(len(slots) for _, slots in pending.values())
+            stats.cache_hits += (sum(1 for leaf, _ in leafs
+                                     if not leaf.terminal and
+                                     not (leaf.expanded and leaf.N))
+                                 - evaluated)
+        return evaluations, batch_priors
 
+    def apply_evaluations(self, leafs: List[Tuple[MCTSNode, C4Game]],
+                          evaluations: list, batch_priors: list) -> None:
+        """
+        Expands and backpropagates evaluated leaves, removing their virtual
+        loss
+        Parameters
+        ----------
+        leafs: `List[Tuple[MCTSNode, C4Game]]`
+            Leaves as returned by `collect_leaves`
+        evaluations: `list`
+            Leaf values as returned by `evaluate_leaves`
+        batch_priors: `list`
+            Leaf policies as returned by `evaluate_leaves`
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        # leaf_value is how good it is for CURRENT player of the state
+        for (leaf, look_position), prior in zip(leafs, batch_priors):
+            # we could have 2 or more searches on one leaf
+            if not leaf.expanded and not leaf.terminal:
+                leaf.expand(prior, look_position, self.pool)
+        if stats is not None:
+            backprop_start = time.perf_counter()
+            stats.time['expand'] += backprop_start - start
+        # backprop
+        for (leaf, _), ev in zip(leafs, evaluations):
+            leaf.backprop(-ev)
+        if stats is not None:
+            stats.time['backprop'] += time.perf_counter() - backprop_start
+
+    def root_probs(self) -> List[float]:
+        """
+        Returns
+        -------
+        search_probs: `List[float]`
+            The visit share of each of the 7 columns at the top node
+        """
         # calculate root children probabilities, and fill in the invalid ones
         # with 0
-        root_children_probs = []
-        ind = 0
-        allowed = self.base_position.legal_moves()
-        for mv in range(7):
-            move = mv
-            if allowed[move]:
-                root_children_probs.append(self.top_node.children[ind].N /
-                                           self.top_node.N)
-                ind += 1
-            else:
-                root_children_probs.append(0)
-
-        return root_children_probs
+        # (unvisited children are never materialised, so they count 0)
+        return [n / self.top_node.N for n in self.top_node.visit_counts()]
 
     def search_for_time(self, duration: float) -> np.ndarray:
         """
@@ -369,15 +962,58 @@ class MCTS:
             return ind
         # stochastic = selfplay game
         # apply the dirichlet noise at move selection
-        dirichlet = np.random.dirichlet([self.dir_alpha] * len(search_probs))
-        noisy_probs = np.array(search_probs) * 0.84 + dirichlet * 0.16
-        # normally we would
-        # let v = a vector of visits
-        # v ^ (1 / temp)
-        # but due to overflow problems, we rearrange
-        # v ^ (1 / temp) = exp(log(v ^ (1 / temp))) = exp(log(v) / temp)
-        new_probs = softmax(np.log(noisy_probs + 1e-10) / temp)
-        return np.random.choice(self.top_node.children, 1, p=new_probs)[0].move
+        legal = np.zeros((1, 7), dtype=bool)
+        legal[0, list(self.top_node.moves)] = True
+        return int(select_moves([search_probs], temp, self.rng,
+                                self.dir_alpha, legal=legal)[0])
+
+    def best_child(self) -> MCTSNode:
+        """
+        Returns
+        -------
+        best: `MCTSNode`
+            The most visited child of the top node. Children are only made
+            when first selected, so if none has been visited yet, as after
+            a single batch, the search is extended until one has
+        Raises
+        ------
+        `ValueError`
+            The top node has no legal moves
+        """
+        top = self.top_node
+        while True:
+            if top.expanded and not top.moves:
+                raise ValueError('The position has no legal moves')
+            visited = [c for c in top.children if c.N]
+            if visited:
+                return max(visited, key=lambda c: c.N)
+            self.playouts = max(self.playouts, top.N + self.batch_size)
+            self.playout_to_max()
+
+    def reroot(self, move: int) -> None:
+        """
+        Makes the child reached by `move` the new top node for tree reuse.
+        The rest of the tree is returned to the pool. The move must be played
+        on the base position separately
+        Parameters
+        ----------
+        move: `int`
+            The move that was played
+        """
+        new_top = None
+        for c in self.top_node.children:
+            if c.move == move:
+                new_top = c
+            else:
+                self.pool.release(c)
+        self.top_node.kids = None
+        self.pool.release(self.top_node)
+        if new_top is None:  # never expanded
+            new_top = self.pool.create()
+        new_top.parent = None
+        new_top.move = None
+        new_top.P = None
+        self.top_node = new_top
 
     def get_pv(self) -> List[MCTSNode]:
         """
@@ -0,0 +1,416 @@
+"""
+Multi-core search for mcts_v2
+Two modes are supported:
+    - Root parallelisation: several processes search independent trees of
+        the same position and their root visit counts are merged
+    - Tree parallelisation: several threads search one shared tree. Virtual
+        loss keeps the threads on different paths
+Either way, network evaluations go through one `BatchedEvaluator`, which
+merges the requests of every searcher into shared `predict` calls.
+Usage: python parallel_search.py MODEL_FILE [options]
+"""
+import argparse
+import multiprocessing as mp
+import queue
+import threading
+import time
+from array import array
+from typing import List, Tuple
+
+import numpy as np
+from keras.models import Model
+
+from c4game import C4Game
+from mcts_v2 import MCTS
+
+
+class BatchedEvaluator:
+    """
+    Thread-safe wrapper of a network which merges concurrent `predict` calls
+    into batches. It can be passed anywhere a network is expected.
+    With keras, call `network._make_predict_function()` before starting, as
+    the network is used from the evaluator's own thread.
+    """
+
+    def __init__(self, network: Model, max_batch: int = 256,
+                 max_wait: float = 0.002) -> None:
+        """
+        Parameters
+        ----------
+        network: `keras.models.Model`
+            The neural network
+        max_batch: `int`
+            Defaults to 256. Requests are merged up to this many positions
+        max_wait: `float`
+            Defaults to 0.002. The seconds to wait for more requests once the
+            first request of a batch has arrived
+        """
+        self.network = network
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.calls = 0  # network predict calls
+        self.positions = 0  # positions evaluated
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self) -> 'BatchedEvaluator':
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> 'BatchedEvaluator':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def predict(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Parameters
+        ----------
+        x: `np.ndarray`
+            A batch of input planes
+        Returns
+        -------
+        value, policy: `Tuple[np.ndarray, np.ndarray]`
+            As per the network, for this request only
+        """
+        request = [x, threading.Event(), None]
+        self.requests.put(request)
+        request[1].wait()
+        if isinstance(request[2], Exception):
+            raise request[2]
+        return request[2]
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                batch = [self.requests.get(timeout=0.05)]
+            except queue.Empty:
+                continue
+            size = len(batch[0][0])
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    request = self.requests.get(
+                        timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            try:
+                value, policy = self.network.predict(
+                    np.concatenate([r[0] for r in batch]))
+            except Exception as e:
+                for r in batch:
+                    r[2] = e
+                    r[1].set()
+                continue
+            self.calls += 1
+            self.positions += size
+            start = 0
+            for r in batch:
+                end = start + len(r[0])
+                r[2] = (value[start:end], policy[start:end])
+                r[1].set()
+                start = end
+
+
+class PipeNetwork:
+    """
+    Stand-in network for a search process, forwarding `predict` calls to the
+    parent process over a pipe
+    """
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+
+    def predict(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        self.conn.send(('predict', x))
+        return self.conn.recv()
+
+
+def _root_worker(conn, position: C4Game, playouts: int, c_puct: float,
+                 batch_size: int, root_noise: float, dir_alpha: float,
+                 seed: int) -> None:
+    """
+    Searches one independent tree in a child process and sends its root
+    visit counts back
+    """
+    np.random.seed(seed)
+    eng = MCTS(position, False, PipeNetwork(conn), c_puct, 1, batch_size)
+    eng.playout_to_max()  # expand the top node
+    top = eng.top_node
+    if root_noise and top.expanded:
+        # without noise every process would grow the same tree
+        noise = np.random.dirichlet([dir_alpha] * len(top.moves))
+        top.priors = array('f', np.array(top.priors) * (1 - root_noise) +
+                           noise * root_noise)
+    eng.playouts = playouts
+    eng.playout_to_max()
+    conn.send(('done', top.visit_counts()))
+    conn.close()
+
+
+def root_parallel_search(position: C4Game, evaluator: BatchedEvaluator,
+                         playouts: int, workers: int, c_puct: float = 3,
+                         batch_size: int = 16, root_noise: float = 0.25,
+                         dir_alpha: float = 1.4) -> List[float]:
+    """
+    Parameters
+    ----------
+    position: `C4Game`
+        The position to search
+    evaluator: `BatchedEvaluator`
+        A started evaluator shared by all the processes
+    playouts: `int`
+        The total number of playouts, split between the processes
+    workers: `int`
+        The number of search processes
+    c_puct: `float`
+        Constant controlling exploration
+    batch_size: `int`
+        Leaves collected per process before each evaluation
+    root_noise: `float`
+        Defaults to 0.25. The share of Dirichlet noise mixed into the root
+        priors of each process so that the trees differ
+    dir_alpha: `float`
+        Defaults to 1.4. The alpha of the root noise
+    Returns
+    -------
+    search_probs: `List[float]`
+        The merged visit share of each of the 7 columns
+    """
+    ctx = mp.get_context('spawn')
+    visits = np.zeros(7)
+    lock = threading.Lock()
+    errors = []
+
+    def bridge(conn):
+        # serve one process, its requests are merged with everyone else's
+        try:
+            while True:
+                kind, data = conn.recv()
+                if kind == 'done':
+                    with lock:
+                        visits[:] += data
+                    return
+                conn.send(evaluator.predict(data))
+        except Exception as e:
+            # EOFError if the process died. Closing the pipe also ends a
+            # process still waiting on a failed evaluation
+            with lock:
+                errors.append(e)
+        finally:
+            conn.close()
+
+    procs, bridges, child_conns = [], [], []
+    for i in range(workers):
+        parent_conn, child_conn = ctx.Pipe()
+        share = playouts // workers + (i < playouts % workers)
+        procs.append(ctx.Process(
+            target=_root_worker,
+            args=(child_conn, position.state_copy(), share, c_puct,
+                  batch_size, root_noise, dir_alpha,
+                  np.random.randint(2 ** 31)),
+            daemon=True))
+        child_conns.append(child_conn)
+        bridges.append(threading.Thread(target=bridge, args=(parent_conn,)))
+    for p in procs:
+        p.start()
+    # only the children hold their ends now, so a dead child reads as EOF
+    for c in child_conns:
+        c.close()
+    for b in bridges:
+        b.start()
+    for b in bridges:
+        b.join()
+    for p in procs:
+        p.join()
+    if errors:
+        raise RuntimeError(
+            f'{len(errors)} of {workers} search processes failed, exit '
+            f'codes {[p.exitcode for p in procs]}') from errors[0]
+    if not visits.sum():
+        raise RuntimeError('The search processes made no visits')
+    return [float(v) for v in visits / visits.sum()]
+
+
+class _UnlockedNetwork:
+    """
+    Network wrapper which releases a held lock while waiting on `predict`
+    """
+
+    def __init__(self, network: Model, lock: threading.Lock) -> None:
+        self.network = network
+        self.lock = lock
+
+    def predict(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        self.lock.release()
+        try:
+            return self.network.predict(x)
+        finally:
+            self.lock.acquire()
+
+
+class TreeParallelMCTS(MCTS):
+    """
+    MCTS where several threads grow one shared tree. All tree work
+    (selection, expansion and backup, the evaluation cache and stats)
+    happens under one lock, so it never runs in parallel. The lock is only
+    released while a thread waits on the network, so the other threads'
+    tree work overlaps with that wait, and their batches are merged into
+    larger network calls. Any speedup comes from that, not from parallel
+    tree work.
+    The network should be a started `BatchedEvaluator`, so that the threads'
+    batches are merged. Trimming a full tree is not supported
+    """
+
+    def __init__(self, *args, threads: int = 4, **kwargs) -> None:
+        """
+        Parameters as per `MCTS`, plus
+        threads: `int`
+            Defaults to 4. The number of search threads
+        """
+        kwargs['trim_when_full'] = False
+        super(TreeParallelMCTS, self).__init__(*args, **kwargs)
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.network = _UnlockedNetwork(self.network, self.lock)
+        self.in_flight = 0  # leaves collected but not yet backed up
+        self.error = None  # the first failure of a search thread
+
+    def _search_worker(self) -> None:
+        with self.lock:
+            while (self.error is None and
+                   self.top_node.N + self.in_flight < self.playouts):
+                leafs = self.collect_leaves(self.batch_size)
+                self.in_flight += len(leafs)
+                evaluated = False
+                try:
+                    # the lock is only released inside the network's predict
+                    evaluations, batch_priors = self.evaluate_leaves(leafs)
+                    evaluated = True
+                    self.apply_evaluations(leafs, evaluations, batch_priors)
+                except Exception as e:
+                    if not evaluated:
+                        # nothing was backed up, so take the virtual loss off
+                        for leaf, _ in leafs:
+                            while leaf is not None:
+                                leaf.VL -= 1
+                                leaf = leaf.parent
+                    self.error = e
+                    return
+                finally:
+                    self.in_flight -= len(leafs)
+
+    def playout_to_max(self) -> List[float]:
+        """
+        Returns
+        -------
+        search_probs: `List[float]`
+            As per `MCTS.playout_to_max`
+        Raises
+        ------
+        `Exception`
+            The first error of a search thread, once all have stopped
+        """
+        self.error = None
+        workers = [threading.Thread(target=self._search_worker)
+                   for _ in range(self.threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if self.error is not None:
+            raise self.error
+        return self.root_probs()
+
+
+def scaling_benchmark(position: C4Game, network: Model, playouts: int,
+                      max_workers: int, mode: str = 'root',
+                      batch_size: int = 16) -> List[dict]:
+    """
+    Searches the same position with 1 to `max_workers` workers. In 'tree'
+    mode the workers share one lock for all tree work, so the speedup shown
+    is from network waits overlapping, not from parallel tree work
+    Parameters
+    ----------
+    position: `C4Game`
+        The position to search
+    network: `keras.models.Model`
+        The neural network
+    playouts: `int`
+        The playouts of every search
+    max_workers: `int`
+        The largest number of processes or threads to try
+    mode: `str`
+        'root' or 'tree'
+    batch_size: `int`
+        Leaves collected per worker before each evaluation
+    Returns
+    -------
+    results: `List[dict]`
+        Workers, seconds, playouts/s, speedup and network batch statistics
+        of each run
+    """
+    results = []
+    for workers in range(1, max_workers + 1):
+        with BatchedEvaluator(network) as evaluator:
+            start = time.time()
+            if mode == 'root':
+                root_parallel_search(position, evaluator, playouts, workers,
+                                     batch_size=batch_size)
+            else:
+                eng = TreeParallelMCTS(position, False, evaluator, 3,
+                                       playouts, batch_size, threads=workers)
+                eng.playout_to_max()
+            elapsed = time.time() - start
+        results.append({
+            'workers': workers,
+            'seconds': elapsed,
+            'playouts_per_s': playouts / elapsed,
+            'speedup': results[0]['seconds'] / elapsed if results else 1.0,
+            'predict_calls': evaluator.calls,
+            'mean_batch': evaluator.positions / max(1, evaluator.calls)})
+        label = 'root' if mode == 'root' else 'tree (network overlap only)'
+        print(f'{label} workers={workers} time={elapsed:.2f}s '
+              f'playouts/s={playouts / elapsed:.0f} '
+              f'speedup={results[-1]["speedup"]:.2f} '
+              f'mean batch={results[-1]["mean_batch"]:.1f}')
+    return results
+
+
+def main() -> None:
+    from keras.models import load_model
+
+    parser = argparse.ArgumentParser(
+        description='Multi-core search scaling benchmark')
+    parser.add_argument('model', help='keras model file')
+    parser.add_argument('--mode', choices=('root', 'tree'), default='root')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count())
+    parser.add_argument('--playouts', type=int, default=4000)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--moves', default='',
+                        help='moves from the start position, e.g. 3342')
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    model._make_predict_function()
+    position = C4Game()
+    for m in args.moves:
+        position.play_move(int(m))
+    scaling_benchmark(position, model, args.playouts, args.workers,
+                      args.mode, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Perft for the game implementations: counts the leaf nodes of the full game
+tree to a fixed depth using play_move/undo_move/check_terminal, and checks
+the counts against known values. Games which are over are not searched any
+further. Doubles as a throughput benchmark and as a correctness gate for
+board representation work. `C4GameBatch` is counted breadth first, one
+batch per depth.
+Usage: python perft.py [--depth D] [--json]
+"""
+import argparse
+import json
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from c4game import C4Game, C4GameBatch
+
+
+# moves from the start position -> leaf counts from depth 0 upwards
+KNOWN_COUNTS: Dict[str, List[int]] = {
+    '': [1, 7, 49, 343, 2401, 16807, 117649, 823536, 5673234],
+    '3332': [1, 7, 49, 343, 2400, 16776, 115595],
+    '4004123301006501436': [1, 6, 30, 180, 855, 4869, 21805],
+    '16442316042550144635412210506561': [1, 5, 23, 56, 190, 326, 675],
+}
+
+
+def perft(game, depth: int) -> Tuple[int, int]:
+    """
+    Parameters
+    ----------
+    game:
+        The position to count from, which is restored on return
+    depth: `int`
+        The depth to count leaf nodes at
+    Returns
+    -------
+    leaves: `int`
+        The number of leaf nodes at `depth`
+    moves: `int`
+        The number of moves played to count them
+    """
+    if not depth:
+        return 1, 0
+    leaves = 0
+    moves = 0
+    for col, legal in enumerate(game.legal_moves()):
+        if not legal:
+            continue
+        game.play_move(col)
+        moves += 1
+        over = game.check_terminal() is not None
+        if depth == 1:
+            leaves += 1
+        elif not over:
+            sub_leaves, sub_moves = perft(game, depth - 1)
+            leaves += sub_leaves
+            moves += sub_moves
+        game.undo_move()
+    return leaves, moves
+
+
+def perft_batch(batch: C4GameBatch, depth: int) -> Tuple[int, int]:
+    """
+    Parameters
+    ----------
+    batch: `C4GameBatch`
+        The positions to count from, which are left unchanged
+    depth: `int`
+        The depth to count leaf nodes at
+    Returns
+    -------
+    leaves: `int`
+        The number of leaf nodes at `depth`, summed over the batch
+    moves: `int`
+        The number of moves played to count them
+    """
+    if not depth:
+        return len(batch), 0
+    moves = 0
+    for _ in range(depth - 1):
+        # every legal move of every position of the frontier
+        games, cols = np.nonzero(batch.legal_moves())
+        batch = batch.take(games)
+        batch.play_moves(cols)
+        moves += len(batch)
+        batch = batch.take(batch.check_terminal() == -1)
+    # the last depth is only counted, not played
+    leaves = int(batch.legal_moves().sum())
+    return leaves, moves + leaves
+
+
+def game_from_moves(moves: str) -> C4Game:
+    game = C4Game()
+    for m in moves:
+        game.play_move(int(m))
+    return game
+
+
+def batch_from_moves(moves: str) -> C4GameBatch:
+    return C4GameBatch.from_games([game_from_moves(moves)])
+
+
+# the game implementations under test: setup from a move string, perft
+IMPLEMENTATIONS: Dict[str, Tuple[Callable, Callable]] = {
+    'C4Game': (game_from_moves, perft),
+    'C4GameBatch': (batch_from_moves, perft_batch),
+}
+
+
+def run(max_depth: int) -> Tuple[List[dict], bool]:
+    """
+    Parameters
+    ----------
+    max_depth: `int`
+        The deepest depth to count, capped by the known counts
+    Returns
+    -------
+    results: `List[dict]`
+        Counts, timings and moves per second of every implementation and
+        position
+    ok: `bool`
+        True if every count matched
+    """
+    results = []
+    ok = True
+    for name, (setup, count) in IMPLEMENTATIONS.items():
+        for moves_str, known in KNOWN_COUNTS.items():
+            game = setup(moves_str)
+            depth = min(max_depth, len(known) - 1)
+            start = time.perf_counter()
+            leaves, moves = count(game, depth)
+            elapsed = time.perf_counter() - start
+            correct = leaves == known[depth]
+            ok = ok and correct
+            results.append({
+                'implementation': name,
+                'position': moves_str or 'startpos',
+                'depth': depth,
+                'leaves': leaves,
+                'expected': known[depth],
+                'correct': correct,
+                'seconds': elapsed,
+                'moves_per_s': moves / elapsed if elapsed else 0.0,
+            })
+    return results, ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Perft for C4Game and C4GameBatch')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    results, ok = run(args.depth)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            status = ('ok' if r['correct'] else
+                      f'WRONG, expected {r["expected"]}')
+            print(f'{r["implementation"]} {r["position"]} d={r["depth"]} '
+                  f'leaves={r["leaves"]} {status} '
+                  f'{r["moves_per_s"]:.0f} moves/s')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
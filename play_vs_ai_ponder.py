@@ -9,11 +9,14 @@ import tensorflow as tf
 from keras.models import Model, load_model
 
 from c4game import C4Game
-from mcts_v2 import MCTS
+from mcts_v2 import MCTS, NodePool
+from parallel_search import BatchedEvaluator, TreeParallelMCTS
 
 
 # network
 MODEL_FILE = './testXVI/save_2071.ntwk'
+MAX_TREE_MB = 1024
+SEARCH_THREADS = 1  # more than 1 ponders on several threads
 MODEL = load_model(MODEL_FILE)
 POSITION = C4Game()
 ENG_POSITION = C4Game()
@@ -54,18 +57,20 @@ def search(position: C4Game, model: Model, eng: MCTS):
 
 
 def apply_move(eng: MCTS, move: int):
-    for node in eng.top_node.children:
-        if node.move == move:
-            break
-    node.parent = None
-    node.move = None
-    node.P = None
-    eng.top_node = node
-    eng.playouts = node.N
+    eng.reroot(move)
+    eng.playouts = eng.top_node.N
 
 
 # finish the definitions
-ENGINE = MCTS(ENG_POSITION, False, MODEL, 3, 2, 10)
+# pondering never stops on its own, so hold the tree to a memory budget
+if SEARCH_THREADS > 1:
+    ENGINE = TreeParallelMCTS(ENG_POSITION, False,
+                              BatchedEvaluator(MODEL).start(), 3, 2, 10,
+                              max_nodes=NodePool.nodes_for_memory(MAX_TREE_MB),
+                              threads=SEARCH_THREADS)
+else:
+    ENGINE = MCTS(ENG_POSITION, False, MODEL, 3, 2, 10,
+                  max_nodes=NodePool.nodes_for_memory(MAX_TREE_MB))
 
 search_info = []
 
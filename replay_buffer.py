@@ -0,0 +1,282 @@
+"""
+Prioritized experience replay for the training pipeline. Positions are
+sampled in proportion to a priority, usually their last training loss, so
+minibatches are spent on the positions the network still gets wrong. A sum
+tree keeps sampling and priority updates O(log n). Either buffer can merge
+repeated positions, such as the opening, into one weighted entry.
+"""
+import copy
+import hashlib
+from collections.abc import Sequence
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+
+class SumTree:
+    """
+    Binary tree of priorities where every inner node holds the sum of its
+    children, stored as one array with the root at 1 and the leaves at
+    `size` onwards
+    """
+
+    def __init__(self, capacity: int) -> None:
+        """
+        Parameters
+        ----------
+        capacity: `int`
+            The number of leaves, rounded up to a power of 2
+        """
+        self.capacity = capacity
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.tree = np.zeros(2 * self.size)
+
+    @property
+    def total(self) -> float:
+        return float(self.tree[1])
+
+    def __getitem__(self, index) -> np.ndarray:
+        return self.tree[np.asarray(index) + self.size]
+
+    def update(self, indices: np.ndarray, priorities: np.ndarray) -> None:
+        """
+        Parameters
+        ----------
+        indices: `np.ndarray`
+            The leaves to set, which should be distinct
+        priorities: `np.ndarray`
+            Their new priorities
+        """
+        nodes = np.asarray(indices) + self.size
+        self.tree[nodes] = priorities
+        for _ in range(self.size.bit_length() - 1):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = (self.tree[2 * nodes] +
+                                self.tree[2 * nodes + 1])
+
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        values: `np.ndarray`
+            Points in [0, total)
+        Returns
+        -------
+        indices: `np.ndarray`
+            For each value, the leaf whose span of the cumulative priorities
+            contains it
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        # every value descends one level per step
+        for _ in range(self.size.bit_length() - 1):
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values -= left * right
+            nodes = 2 * nodes + right
+        return np.minimum(nodes - self.size, self.capacity - 1)
+
+
+class ReplayBuffer(Sequence):
+    """
+    A fixed size buffer of training samples, the oldest being overwritten
+    first. It stands in for the pipeline's deque (len, indexing, iteration,
+    extend, pickling). Samples are (state, result, move made, visits)
+    tuples, and with `aggregate`, samples of a position already in the
+    buffer are merged into its entry: the entry holds the mean result, move
+    and visits, and counts the samples merged, whose square root is its
+    sample weight
+    """
+
+    def __init__(self, maxlen: int, aggregate: bool = False) -> None:
+        """
+        Parameters
+        ----------
+        maxlen: `int`
+            The number of entries kept
+        aggregate: `bool`
+            Defaults to False. Merge samples of the same position
+        """
+        self.maxlen = maxlen
+        self.aggregate = aggregate
+        self.data = []
+        self.counts = []  # samples merged into each entry
+        self.sums = []  # result, move and visits sums of each entry
+        self.keys = []  # position hash of each entry
+        self.index = {}  # position hash -> entry
+        self.next_index = 0  # the entry overwritten next once full
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index: int):
+        return self.data[index]
+
+    def __iter__(self) -> Iterator:
+        return iter(self.data)
+
+    def __copy__(self) -> 'ReplayBuffer':
+        # a snapshot, which later extends do not change
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other.data = list(self.data)
+        other.counts = list(self.counts)
+        other.sums = [s if s is None else list(s) for s in self.sums]
+        other.keys = list(self.keys)
+        other.index = dict(self.index)
+        return other
+
+    @staticmethod
+    def position_key(state: np.ndarray) -> bytes:
+        # stable across processes, unlike hash(), so a pickled buffer works
+        return hashlib.blake2b(np.ascontiguousarray(state).tobytes(),
+                               digest_size=8).digest()
+
+    def append(self, sample) -> None:
+        self.extend([sample])
+
+    def extend(self, samples: Iterable) -> None:
+        touched = []
+        for sample in samples:
+            key = self.position_key(sample[0]) if self.aggregate else None
+            i = self.index.get(key) if self.aggregate else None
+            if i is not None:
+                self.counts[i] += 1
+                sums = self.sums[i]
+                for j, value in enumerate(sample[1:]):
+                    sums[j] = sums[j] + value
+                count = self.counts[i]
+                self.data[i] = (self.data[i][0],
+                                *(total / count for total in sums))
+            else:
+                i = self._new_entry(key)
+                self.data[i] = sample
+                self.counts[i] = 1
+                if self.aggregate:
+                    self.sums[i] = list(sample[1:])
+            touched.append(i)
+        if touched:
+            self._touched(np.unique(touched))
+
+    def _new_entry(self, key: bytes) -> int:
+        if len(self.data) < self.maxlen:
+            i = len(self.data)
+            self.data.append(None)
+            self.counts.append(0)
+            self.sums.append(None)
+            self.keys.append(None)
+        else:
+            i = self.next_index
+            self.next_index = (self.next_index + 1) % self.maxlen
+            self.index.pop(self.keys[i], None)
+        if self.aggregate:
+            self.keys[i] = key
+            self.index[key] = i
+        return i
+
+    def _touched(self, indices: np.ndarray) -> None:
+        """
+        Called with the entries added to or merged into by `extend`
+        """
+
+    def sample_weights(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Returns
+        -------
+        weights: `np.ndarray`
+            The square root of the number of samples merged into each entry,
+            over their mean. The empty board is merged from every game, so
+            a linear weight would let it swamp the minibatch loss; the root
+            still favours common positions but keeps them in proportion
+        """
+        counts = np.array([self.counts[i] for i in indices], dtype=np.float64)
+        weights = np.sqrt(counts)
+        return weights / weights.mean()
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    `ReplayBuffer` with prioritized sampling
+    """
+
+    def __init__(self, maxlen: int, alpha: float = 0.6, beta: float = 0.4,
+                 eps: float = 1e-3, aggregate: bool = False) -> None:
+        """
+        Parameters
+        ----------
+        maxlen, aggregate:
+            As per `ReplayBuffer`
+        alpha: `float`
+            Defaults to 0.6. How strongly priorities skew sampling, 0 being
+            uniform
+        beta: `float`
+            Defaults to 0.4. How much of the sampling bias the importance
+            sampling weights correct, 1 being all of it
+        eps: `float`
+            Defaults to 1e-3. Added to every loss, so samples which are
+            already learnt can still be drawn
+        """
+        super().__init__(maxlen, aggregate)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.tree = SumTree(maxlen)
+        self.max_priority = 1.0
+
+    def __copy__(self) -> 'PrioritizedReplayBuffer':
+        other = super().__copy__()
+        other.tree = copy.deepcopy(self.tree)
+        return other
+
+    def _touched(self, indices: np.ndarray) -> None:
+        # at the highest priority so far, so new data is seen soon
+        self.tree.update(indices, np.full(len(indices), self.max_priority))
+
+    def sample(self, n: int, rng: np.random.Generator = None
+               ) -> Tuple[np.ndarray, List, np.ndarray]:
+        """
+        Parameters
+        ----------
+        n: `int`
+            The number of samples to draw, with replacement
+        rng: `np.random.Generator`
+            Defaults to None, for a new unseeded generator
+        Returns
+        -------
+        indices: `np.ndarray`
+            The buffer index of each sample, for `update_priorities`
+        samples: `List`
+            The samples
+        weights: `np.ndarray`
+            Importance sampling weights, scaled so the largest is 1
+        """
+        rng = rng if rng is not None else np.random.default_rng()
+        # one draw from each of n equal spans, for a more even spread
+        total = self.tree.total
+        points = (np.arange(n) + rng.random(n)) * (total / n)
+        indices = self.tree.find(np.minimum(points, total * (1 - 1e-12)))
+        indices = np.minimum(indices, len(self.data) - 1)
+        probs = self.tree[indices] / total
+        weights = (len(self.data) * probs) ** -self.beta
+        weights /= weights.max()
+        return indices, [self.data[i] for i in indices], weights
+
+    def update_priorities(self, indices: np.ndarray,
+                          losses: np.ndarray) -> None:
+        """
+        Parameters
+        ----------
+        indices: `np.ndarray`
+            As returned by `sample`
+        losses: `np.ndarray`
+            The latest loss of each sample
+        """
+        # a sample drawn twice keeps its last loss
+        indices, last = np.unique(np.asarray(indices)[::-1],
+                                  return_index=True)
+        losses = np.asarray(losses)[::-1][last]
+        priorities = (losses + self.eps) ** self.alpha
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(indices, priorities)
@@ -13,15 +13,19 @@ from keras.models import Model, load_model
 
 from c4game import C4Game
 # from mcts import MCTS
-from mcts_v2 import MCTS
+from mcts_v2 import MCTS, NodePool, SearchStats
+from parallel_search import BatchedEvaluator, TreeParallelMCTS
 
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 # network
 MODEL_FILE = './testXVI/save_2071.ntwk'
+MAX_TREE_MB = 1024  # search tree memory budget for long `go t=` searches
+SEARCH_THREADS = 1  # more than 1 searches one shared tree on several threads
 MODEL = load_model(MODEL_FILE)
 POSITION = C4Game()
+STATS = SearchStats()  # accumulated over searches, see the `stats` command
 
 
 class SearchThread(threading.Thread):
@@ -48,7 +52,15 @@ def search(position: C4Game, model: Model, *,
     if stime is not None:
         nodes = float('inf')
     # search thread method
-    eng = MCTS(position, False, model, 3, 2, 10)
+    if SEARCH_THREADS > 1:
+        eng = TreeParallelMCTS(position, False, EVALUATOR, 3, 2, 10,
+                               max_nodes=NodePool.nodes_for_memory(
+                                   MAX_TREE_MB),
+                               threads=SEARCH_THREADS, stats=STATS)
+    else:
+        eng = MCTS(position, False, model, 3, 2, 10,
+                   max_nodes=NodePool.nodes_for_memory(MAX_TREE_MB),
+                   stats=STATS, adaptive_batch=True)
     start_time = time.time()
     cycle = -1
     pv = []
@@ -77,6 +89,7 @@ def search(position: C4Game, model: Model, *,
     print('\n'.join(str(x) for x in eng.top_node.children))
     pv = eng.get_pv()
     print(f'nodes {eng.playouts} pv ' + ' '.join(str(x.move) for x in pv))
+    print(f'tree {eng.pool.size} nodes')
     print(f'bestmove {pv[0]}')
     SEARCH_THREAD.stop()  # set stopped flag
 
@@ -84,10 +97,13 @@ def search(position: C4Game, model: Model, *,
 def main():
     global SEARCH_THREAD
     global POSITION
+    global EVALUATOR
     SEARCH_THREAD = None
     # prepare the model
     MODEL._make_predict_function()
     tf.get_default_graph().finalize()
+    if SEARCH_THREADS > 1:
+        EVALUATOR = BatchedEvaluator(MODEL).start()
     searching = False
     while True:
         inp = input()
@@ -114,6 +130,10 @@ def main():
             SEARCH_THREAD.stop()
         if inp == 'isready':
             print('readyok')
+        if inp == 'stats':
+            print(STATS)
+        if inp == 'stats reset':
+            STATS.reset()
         if inp.startswith('mv') and not searching:
             try:
                 move = int(inp.split(' ')[1])
@@ -146,21 +166,10 @@ def main():
                             print(e)
                             POSITION = C4Game()
             if len(inp) > 3 and inp[1] == 'set':
-                POSITION = C4Game()
-                pstr = inp[2]  # position string representation
-                gstr = ''  # geometric string representation
-                for c in pstr:
-                    if c.upper() in 'XO/':
-                        gstr += c.upper()
-                    if c.isdigit():
-                        gstr += ' ' * int(c)
-                gstr = gstr.split('/')
-                rpos = np.array([list(x) for x in gstr])  # rotated position
-                pos90 = np.rot90(rpos, k=3)  # rotated correctly
-                mat = np.zeros((7, 6)) - (pos90 == 'X') + (pos90 == 'O')
-                POSITION.position = mat
-                POSITION.to_move = -1 if inp[3].upper() == 'X' else 1
-                POSITION.position_history = [mat.copy()]
+                try:
+                    POSITION = C4Game.from_string(inp[2], inp[3])
+                except ValueError as e:
+                    print(e)
             inp = ' '.join(inp)
         if inp.startswith('image'):
             print(np.moveaxis(POSITION.state, 2, 0))
@@ -12,7 +12,7 @@ from mcts_v2 import MCTS
 def do_selfplay(num: int, playouts: int,
                 c_puct: float, mdl: Model,
                 dir_alpha: float, temp_cutoff: int,
-                mcts_batch_size: int) -> tuple:
+                mcts_batch_size: int, seed: int = None) -> tuple:
     """
     Do and save to a file some selfplay games
     Parameters
@@ -27,16 +27,22 @@ def do_selfplay(num: int, playouts: int,
         Model used for predictions
     dir_alpha: `float`
         Dirichlet noise alpha value
+    seed: `int`
+        Defaults to None. Seed of the random generator, for reproducible
+        games given the same model. Adaptive leaf batching depends on
+        timings, so it is only used without a seed
 
     Yields
     ------
     `Tuple[np.ndarray, int, int]`
     """
+    rng = np.random.default_rng(seed)
     for game_num in range(num):
         print(f'Starting self-play game {game_num + 1}/{num}')
         game = C4Game()
         searcher = MCTS(game, True, mdl, c_puct, playouts, dir_alpha=dir_alpha,
-                        batch_size=mcts_batch_size)
+                        batch_size=mcts_batch_size,
+                        adaptive_batch=seed is None, rng=rng)
         state_logs = []
         move_logs = []
         move_search_logs = []
@@ -49,15 +55,6 @@ def do_selfplay(num: int, playouts: int,
             state_logs.append(game.state)
             move_logs.append(move)
             game.play_move(move)
-            # tree reuse
-            searcher_ = MCTS(game, True, mdl, c_puct, playouts,
-                             dir_alpha=dir_alpha, batch_size=mcts_batch_size)
-            for n in searcher.top_node.children:
-                if n.move == move:
-                    n.move = None
-                    n.parent = None
-                    n.P = None
-                    searcher_.top_node = n
-                    break
-            searcher = searcher_
+            # tree reuse, the rest of the tree goes back to the pool
+            searcher.reroot(move)
         yield state_logs, game.check_terminal(), move_logs, move_search_logs
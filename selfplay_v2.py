@@ -1,11 +1,25 @@
 """
 Multithreaded selfplay game generation using subprocesses
-This should work out of the box at with Windows. Binaries will need to be
-manually compiled on other platforms and their respective run commands edited.
+This should work out of the box at with Windows. On Linux, build the engine
+with standalone/CMakeLists.txt first. The engine is found through the
+C4UCT_ENGINE environment variable, else in standalone/Release_x64.
+The engine processes are long-lived: they are kept in a pool between cycles
+and reload the published model in place, so games don't pay for process
+launch and model load. Each game comes back as one binary frame, from which
+the input planes are built at once.
+Running this file plays a smoke test game on the native engine.
+Usage: [C4UCT_ENGINE=path/to/C4UCT] python selfplay_v2.py
 """
+import atexit
+import os
+import queue
 import random
-from subprocess import Popen, PIPE
-from typing import Tuple
+import shutil
+import sys
+import threading
+import time
+from subprocess import DEVNULL, Popen, PIPE
+from typing import List, Tuple
 from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
@@ -15,6 +29,244 @@ from c4game import C4Game
 from onnx_converter import save as save_as_onnx
 
 THREADS = 6
+# seconds to wait for engine output; a whole game is played between the
+# `sspgo` command and its first line
+READ_TIMEOUT = 600
+# the engine runs from its own directory, where it finds Models/
+ENGINE_FILE = os.path.abspath(os.environ.get(
+    'C4UCT_ENGINE', './standalone/Release_x64/C4UCT' +
+    ('.exe' if sys.platform == 'win32' else '')))
+ENGINE_DIR = os.path.dirname(ENGINE_FILE)
+MODEL_FILE = os.path.join(ENGINE_DIR, 'Models', 'temp.onnx')
+
+POOL = None  # the EnginePool, created on first use
+
+
+class SSPEngine:
+    """
+    One engine process in selfplay mode, playing a game per `play` call
+    """
+
+    def __init__(self, timeout: float = READ_TIMEOUT) -> None:
+        """
+        Parameters
+        ----------
+        timeout: `float`
+            Defaults to `READ_TIMEOUT`. The seconds a read waits for output
+        """
+        # binary pipes, as games are sent back as raw bytes. stderr is not
+        # read, so it must not be a pipe which could fill up
+        self.sub = Popen(ENGINE_FILE,
+                         cwd=ENGINE_DIR,
+                         stdin=PIPE,
+                         stdout=PIPE, stderr=DEVNULL)
+        self.timeout = timeout
+        # stdout is read on a thread, so reads can time out
+        self.chunks = queue.Queue()
+        self.buffer = bytearray()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+        try:
+            self.send('ssp')
+            self.wait_ready()
+        except Exception:
+            self.sub.kill()
+            raise
+
+    def _read(self) -> None:
+        while True:
+            chunk = self.sub.stdout.read1(65536)
+            self.chunks.put(chunk)
+            if not chunk:  # EOF
+                return
+
+    def _fill(self, deadline: float) -> None:
+        try:
+            chunk = self.chunks.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            raise RuntimeError(f'No engine output in {self.timeout}s')
+        if not chunk:
+            self.chunks.put(chunk)  # every later read sees the EOF too
+            raise RuntimeError('Engine process exited')
+        self.buffer += chunk
+
+    def send(self, command: str) -> None:
+        self.sub.stdin.write((command + '\n').encode())
+        self.sub.stdin.flush()
+
+    def read_line(self) -> str:
+        deadline = time.time() + self.timeout
+        while b'\n' not in self.buffer:
+            self._fill(deadline)
+        end = self.buffer.index(b'\n') + 1
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line.decode().strip()
+
+    def read_bytes(self, n: int) -> bytes:
+        deadline = time.time() + self.timeout
+        while len(self.buffer) < n:
+            self._fill(deadline)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def wait_ready(self) -> None:
+        self.send('isready')
+        while self.read_line() != 'readyok':
+            pass
+
+    def alive(self) -> bool:
+        return self.sub.poll() is None
+
+    def reload(self) -> None:
+        """
+        Reloads the model file in place
+        Raises
+        ------
+        `RuntimeError`
+            The engine could not load the model
+        """
+        self.send('reload')
+        while True:
+            line = self.read_line()
+            if line == 'reloaded':
+                return
+            if line.startswith('reload failed'):
+                raise RuntimeError(line)
+
+    def play(self, playouts: int, c_puct: float, dir_alpha: float,
+             temp_cutoff: int, seed: int) -> tuple:
+        """
+        Plays one selfplay game
+        Returns
+        -------
+        `Tuple[List[np.ndarray], int, List[int], List[np.ndarray]]`
+            States, result, moves and search probabilities, as per
+            `do_selfplay`
+        """
+        self.send(f'seed {seed}\nc_puct set {c_puct}\n'
+                  f'dir_alpha set {dir_alpha}\n'
+                  f'temp_cutoff set {temp_cutoff}\n'
+                  f'playouts set {playouts}\nsspgo binary')
+
+        # ignore some lines we don't want
+        while True:
+            line = self.read_line()
+            if line.startswith('seed set to '):
+                break
+
+        # frame: a `game N RESULT` line, N move bytes, N * 7 float32 search
+        # probabilities, then a `done` line
+        header = self.read_line()
+        if header == 'no model':
+            raise RuntimeError('Engine has no model loaded')
+        _, n, result = header.split()
+        n = int(n)
+        moves = np.frombuffer(self.read_bytes(n), dtype=np.uint8)
+        probs = np.frombuffer(self.read_bytes(n * 7 * 4), dtype='<f4')
+        if self.read_line() != 'done':
+            raise RuntimeError('Engine output out of sync')
+        state_logs = list(C4Game.states_from_moves(moves))
+        move_search_logs = list(probs.reshape(n, 7).astype('float'))
+        return (state_logs, int(result), [int(m) for m in moves],
+                move_search_logs)
+
+    def close(self) -> None:
+        try:
+            self.send('exit')
+            self.sub.wait(timeout=5)
+        except Exception:
+            self.sub.kill()
+
+
+class EnginePool:
+    """
+    A fixed set of long-lived engine processes, checked out one game at a
+    time
+    """
+
+    def __init__(self, size: int) -> None:
+        """
+        Parameters
+        ----------
+        size: `int`
+            The number of engine processes
+        """
+        self.size = size
+        self.engines: List[SSPEngine] = [SSPEngine() for _ in range(size)]
+        self.idle = queue.Queue()
+        for eng in self.engines:
+            self.idle.put(eng)
+
+    def play(self, *args) -> tuple:
+        """
+        Plays a game on an idle engine, arguments as per `SSPEngine.play`
+        Raises
+        ------
+        `RuntimeError`
+            The game failed, or no engine is left to play it
+        """
+        while True:
+            if not self.engines:
+                raise RuntimeError('No engine is running')
+            try:
+                eng = self.idle.get(timeout=1)
+                break
+            except queue.Empty:
+                continue
+        try:
+            return eng.play(*args)
+        except Exception:
+            # a broken engine is replaced, the game is lost. If no engine
+            # can be started, the pool is one short until `reload`
+            eng.close()
+            self.engines.remove(eng)
+            eng = None
+            eng = SSPEngine()
+            self.engines.append(eng)
+            raise
+        finally:
+            if eng is not None and eng.alive():
+                self.idle.put(eng)
+
+    def reload(self) -> None:
+        """
+        Reloads the model in every engine. Must not be called while games
+        are being played
+        """
+        for i, eng in enumerate(self.engines):
+            if not eng.alive():
+                self.engines[i] = SSPEngine()  # loads the model on start
+                continue
+            eng.reload()
+        while len(self.engines) < self.size:
+            self.engines.append(SSPEngine())
+        self.idle = queue.Queue()
+        for eng in self.engines:
+            self.idle.put(eng)
+
+    def close(self) -> None:
+        for eng in self.engines:
+            eng.close()
+        self.engines = []
+
+
+def get_pool() -> EnginePool:
+    """
+    Returns
+    -------
+    pool: `EnginePool`
+        The shared pool, created with `THREADS` engines on first use and
+        reloaded with the current model after that
+    """
+    global POOL
+    if POOL is None:
+        POOL = EnginePool(THREADS)
+        atexit.register(POOL.close)
+    else:
+        POOL.reload()
+    return POOL
 
 
 def do_selfplay(num: int, playouts: int,
@@ -40,57 +292,75 @@ def do_selfplay(num: int, playouts: int,
     ------
     `Tuple[np.ndarray, int, int]`
     """
-    save_as_onnx(mdl, './standalone/Release_x64/Models/temp.onnx')
+    save_as_onnx(mdl, MODEL_FILE)
+    pool = get_pool()
+    for res in play_games(pool, num, playouts, c_puct, dir_alpha,
+                          temp_cutoff):
+        yield res
+
 
-    with ThreadPoolExecutor(max_workers=THREADS) as executor:
-        funcs = [executor.submit(fast_selfplay, playouts, c_puct,
+def play_games(pool: EnginePool, num: int, playouts: int, c_puct: float,
+               dir_alpha: float, temp_cutoff: int) -> List[tuple]:
+    """
+    Plays `num` games on the engines of `pool` with the model they have
+    loaded, arguments as per `do_selfplay`
+    Returns
+    -------
+    games: `List[tuple]`
+        The games which completed, as `do_selfplay` yields them. A game
+        whose engine failed is logged and left out, so there may be fewer
+        than `num`
+    """
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        funcs = [executor.submit(pool.play, playouts, c_puct,
                                  dir_alpha, temp_cutoff,
                                  random.randint(1, 4294967295))
                  for _ in range(num)]
-        results = [f.result() for f in funcs]
-    for res in results:
-        yield res
+        games = []
+        for f in funcs:
+            try:
+                games.append(f.result())
+            except Exception as e:
+                print(f'Selfplay game lost: {e}')
+        return games
 
 
 def fast_selfplay(playouts: int,
                   c_puct: float, dir_alpha: float, temp_cutoff: int,
-                  force_seed: int = None):
+                  force_seed: int = None) -> tuple:
+    """
+    Plays one game on a fresh engine process. `EnginePool` should be
+    preferred for more than one game
+    """
     if force_seed is None:
         force_seed = random.randint(1, 4294967295)
+    eng = SSPEngine()
+    try:
+        return eng.play(playouts, c_puct, dir_alpha, temp_cutoff, force_seed)
+    finally:
+        eng.close()
+
+
+def main() -> None:
+    print(f'Engine: {ENGINE_FILE}')
+    if not os.path.exists(MODEL_FILE):
+        shutil.copy(os.path.join(ENGINE_DIR, 'Models', 'default.onnx'),
+                    MODEL_FILE)
+    start = time.time()
+    pool = EnginePool(2)
+    print(f'Started 2 engines in {time.time() - start:.2f}s')
+    try:
+        for _ in range(2):
+            start = time.time()
+            states, result, moves, _ = pool.play(200, 3, 1.4, 12,
+                                                 random.randint(1, 1000))
+            print(f'Game of {len(moves)} moves, result {result}, '
+                  f'states {states[0].shape}, {time.time() - start:.2f}s')
+            pool.reload()
+        print('Native engine OK')
+    finally:
+        pool.close()
+
 
-    # spawn process
-    sub = Popen('./standalone/Release_x64/C4UCT.exe',
-                cwd='./standalone/Release_x64',
-                universal_newlines=True,
-                stdin=PIPE,
-                stdout=PIPE, stderr=PIPE)
-    sub.stdin.write(f'ssp\nseed {force_seed}\nc_puct set {c_puct}\n'
-                    f'dir_alpha set {dir_alpha}\n'
-                    f'temp_cutoff set {temp_cutoff}\n'
-                    f'playouts set {playouts}\nsspgo\n')
-    sub.stdin.flush()
-
-    # ignore some lines we don't want
-    while True:
-        line = sub.stdout.readline().strip()
-        if line.startswith('seed set to '):
-            break
-
-    game = C4Game()
-    state_logs = []
-    move_logs = []
-    move_search_logs = []
-    while True:
-        info = sub.stdout.readline().strip()
-        if info == 'done':
-            break
-        move = info[-1]
-        info = info[:-3]
-        probs = map(float, info.split(' '))
-        move_search_logs.append(np.array(list(probs)))
-        state_logs.append(game.state)
-        move_logs.append(int(move))
-        game.play_move(int(move))
-
-    sub.kill()
-    return state_logs, game.check_terminal(), move_logs, move_search_logs
+if __name__ == '__main__':
+    main()
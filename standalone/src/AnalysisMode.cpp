@@ -3,6 +3,7 @@
 #include <sstream>
 #include "gsl/gsl_rng.h"
 #include "AnalysisMode.h"
+#include "InputQueue.h"
 #include "MCTSEngine.h"
 #include "MCTSNode.h"
 #include "Model.h"
@@ -32,7 +33,7 @@ int AnalysisMode()
     unsigned long user_value;
     for (;;)
     {
-        std::getline(std::cin, user_in);
+        ReadCommand(user_in);
         if (user_in.size() == 0)
             continue;
         if (user_in.rfind("mv ", 0) == 0)
@@ -71,14 +72,14 @@ int AnalysisMode()
             std::stringstream(number) >> user_value;
             if (user_value < 10)
                 user_value = 10;
-            MCTSEngine eng = MCTSEngine(game, model, 3, user_value);
-            eng.DoPlayouts(true);
-            auto pv = eng.GetPV();
-            if (pv.size() == 0)
+            // the reply ends with either endinfo or end of game
+            if (game.GameOver() != -1)
             {
                 std::cout << "end of game" << std::endl;
                 continue;
             }
+            MCTSEngine eng = MCTSEngine(game, model, 3, user_value);
+            eng.DoPlayouts(true);
         }
         if (user_in == "undo")
             game.UndoMove();
@@ -4,11 +4,13 @@
 #include "GameMode.h"
 #include "TrainUtils.h"
 #include "DebugMode.h"
+#include "InputQueue.h"
 
 
 int main()
 {
     C4Game::init_variables();
+    StartInputThread();
 
     // 0 -> analysis
     // 1 -> ssp
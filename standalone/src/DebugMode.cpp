@@ -4,6 +4,7 @@
 #include <iostream>
 #include <sstream>
 #include "DebugMode.h"
+#include "InputQueue.h"
 #include "C4Game.h"
 #include "MCTSEngine.h"
 #include "ModelManager.h"
@@ -30,7 +31,7 @@ int DBGMode()
     unsigned long user_value;
     for (;;)
     {
-        std::getline(std::cin, user_in);
+        ReadCommand(user_in);
         if (user_in.size() == 0)
             continue;
         if (user_in == "isready")
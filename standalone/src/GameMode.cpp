@@ -2,6 +2,7 @@
 #include <string>
 #include <sstream>
 #include "GameMode.h"
+#include "InputQueue.h"
 #include "MCTSEngine.h"
 
 
@@ -12,7 +13,7 @@ int GameMode()
     std::string user_in;
     std::uint64_t playouts;
     std::cout << "Search playouts (default 5000): ";
-    std::getline(std::cin, user_in);
+    ReadCommand(user_in);
     user_in = user_in.size() == 0 ? "5000" : user_in;
     std::stringstream(user_in) >> playouts;
 
@@ -23,7 +24,7 @@ int GameMode()
         << " MB of RAM." << std::endl;
 
     std::cout << "Model (default save_10k.onnx): ";
-    std::getline(std::cin, user_in);
+    ReadCommand(user_in);
     user_in = user_in.size() == 0 ? "save_10k.onnx" : user_in;
     std::string str_mdl_name = "Models/" + user_in;
     std::cout << "Using model: " << str_mdl_name << std::endl;
@@ -69,7 +70,7 @@ void human_controller(C4Game& state, Model* mdl, std::uint64_t playouts)
     {
         std::cout << "Your turn: ";
         std::string inp;
-        std::getline(std::cin, inp);
+        ReadCommand(inp);
         std::cout.flush();
         if (inp == "go")
         {
@@ -0,0 +1,67 @@
+#include <atomic>
+#include <condition_variable>
+#include <cstdint>
+#include <deque>
+#include <iostream>
+#include <mutex>
+#include <thread>
+#include "InputQueue.h"
+
+
+static std::mutex input_mutex;
+static std::condition_variable input_ready;
+static std::deque<std::string> input_lines;
+static bool input_eof = false;
+
+// commands are numbered from 1 in the order they are read
+static std::uint64_t commands_read = 0;  // reader thread only
+static std::atomic<std::uint64_t> stop_upto{ 0 };  // stop commands <= this
+static std::atomic<std::uint64_t> current_command{ 0 };
+
+
+static void InputLoop()
+{
+    std::string line;
+    while (std::getline(std::cin, line))
+    {
+        if (!line.empty() && line.back() == '\r')
+            line.pop_back();
+        if (line == "stop")
+        {
+            stop_upto = commands_read;
+            continue;
+        }
+        std::lock_guard<std::mutex> lock(input_mutex);
+        input_lines.push_back(line);
+        commands_read++;
+        input_ready.notify_one();
+    }
+    std::lock_guard<std::mutex> lock(input_mutex);
+    input_eof = true;
+    input_ready.notify_one();
+}
+
+void StartInputThread()
+{
+    std::thread(InputLoop).detach();
+}
+
+void ReadCommand(std::string& line)
+{
+    std::unique_lock<std::mutex> lock(input_mutex);
+    input_ready.wait(lock, [] { return !input_lines.empty() || input_eof; });
+    if (input_lines.empty())
+    {
+        // nobody is left to send commands
+        line = "exit";
+        return;
+    }
+    line = input_lines.front();
+    input_lines.pop_front();
+    current_command++;
+}
+
+bool SearchStopped()
+{
+    return stop_upto.load() >= current_command.load();
+}
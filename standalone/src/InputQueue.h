@@ -0,0 +1,20 @@
+#ifndef C4UCT_INPUT_QUEUE_H
+#define C4UCT_INPUT_QUEUE_H
+
+#include <string>
+
+/*
+Standard input is read on its own thread, so that a "stop" line can end a
+search that is running on the main thread. Every mode reads its commands
+through ReadCommand instead of std::getline(std::cin, ...).
+"stop" is never returned as a command. It stops the command being run (or
+the last command read, if that has not started yet).
+*/
+
+
+void StartInputThread();
+void ReadCommand(std::string& line);
+bool SearchStopped();
+
+
+#endif
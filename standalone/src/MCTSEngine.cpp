@@ -1,5 +1,6 @@
 #include <iostream>
 #include "MCTSEngine.h"
+#include "InputQueue.h"
 #include "MCTSNode.h"
 
 
@@ -29,7 +30,9 @@ MCTSEngine::MCTSEngine(C4Game position, Model * network, float c_puct, std::uint
 void MCTSEngine::DoPlayouts(bool verbose)
 {
     std::vector<int> prevpv;
-    while (this->top_node->GetVisits() < this->playouts)
+    // a stopped search still makes one playout, to have a move to give
+    while (this->top_node->GetVisits() < this->playouts &&
+        (this->top_node->GetVisits() < 2 || !SearchStopped()))
     {
         // find the appropriate leaf node
         C4Game look_position(base_position);  // copy it
@@ -47,7 +50,8 @@ void MCTSEngine::DoPlayouts(bool verbose)
         leaf->Expand(look_position, predictions[1], this->nht);
         leaf->Backprop(-predictions[0][0]);
 
-        if (verbose && this->top_node->GetVisits() % 50 == 0)
+        std::uint64_t visits = this->top_node->GetVisits();
+        if (verbose && visits % 50 == 0)
         {
             std::vector<int> currpv = this->GetPV();
             bool changed = prevpv.size() != currpv.size();
@@ -62,9 +66,11 @@ void MCTSEngine::DoPlayouts(bool verbose)
                     }
                 }
             }
-            if (changed)
+            // report a new pv, and progress now and then for listeners
+            if ((changed || visits % 1000 == 0) && currpv.size() > 0)
             {
-                std::cout << "info pv ";
+                std::cout << "info nodes " << visits << " q "
+                    << this->top_node->GetChild(currpv[0])->GetQ() << " pv ";
                 for (auto& move : currpv)
                     std::cout << move << ' ';
                 std::cout << std::endl;
@@ -1,6 +1,7 @@
 #ifndef C4UCT_MODEL_H
 #define C4UCT_MODEL_H
 
+#include <array>
 #include <onnxruntime_cxx_api.h>
 #include "C4Game.h"
 
@@ -2,6 +2,8 @@
 #define C4UCT_MODEL_MANAGER_H
 
 #include <algorithm>
+#include <array>
+#include <vector>
 #include <onnxruntime_cxx_api.h>
 #include "Model.h"
 
@@ -2,18 +2,35 @@
 #include <cfloat>
 #include <math.h>
 #include <iostream>
+#include <memory>
 #include <sstream>
+#include <vector>
+#ifdef _WIN32
+#include <fcntl.h>
+#include <io.h>
+#endif
 #include "gsl/gsl_rng.h"
 #include "gsl/gsl_randist.h"
 #include "TrainUtils.h"
 #include "C4Game.h"
+#include "InputQueue.h"
 #include "MCTSEngine.h"
 #include "ModelManager.h"
 
 
+// the model written by the training pipeline, relative to the engine
+#ifdef _WIN32
+#define SSP_MODEL_PATH L"Models/temp.onnx"
+#else
+#define SSP_MODEL_PATH "Models/temp.onnx"
+#endif
+
+
 int SSPMode()
 {
-    ModelManager model_manager;
+    // held by pointer so that the model can be reloaded in place, which
+    // needs a fresh manager as models hold pointers into the old one
+    std::unique_ptr<ModelManager> model_manager = std::make_unique<ModelManager>();
     std::cout.flush();
 
     gsl_rng* rng = gsl_rng_alloc(gsl_rng_mt19937);
@@ -24,11 +41,7 @@ int SSPMode()
     int temp_cutoff = 12;
     std::uint64_t playouts = 800;
 
-#ifdef _WIN32
-    Model* model = model_manager.CreateModel(L"Models/temp.onnx");
-#else
-    Model* model = model_manager.CreateModel("Models/temp.onnx");
-#endif
+    Model* model = model_manager->CreateModel(SSP_MODEL_PATH);
     C4Game game;
 
     std::cout << "Welcome to selfplay mode." << std::endl;
@@ -38,7 +51,7 @@ int SSPMode()
     unsigned long user_value;
     for (;;)
     {
-        std::getline(std::cin, user_in);
+        ReadCommand(user_in);
         if (user_in.size() == 0)
             continue;
         if (user_in == "game")
@@ -77,16 +90,45 @@ int SSPMode()
         {
             std::cout << "Parameters\nc_puct " << c_puct << "\ndir_alpha " << dir_alpha << "\ntemp_cutoff " << temp_cutoff << "\nplayouts " << playouts << std::endl;
         }
-        if (user_in == "sspgo")
-            StochasticSelfPlay(model, c_puct, dir_alpha, temp_cutoff, playouts, rng);
+        if (user_in == "reload")
+        {
+            // pick up new weights without restarting the process
+            // the old manager is released first so only one Ort::Env exists
+            model = nullptr;
+            model_manager.reset();
+            model_manager = std::make_unique<ModelManager>();
+            try
+            {
+                model = model_manager->CreateModel(SSP_MODEL_PATH);
+                std::cout << "reloaded" << std::endl;
+            }
+            catch (const Ort::Exception& e)
+            {
+                std::cout << "reload failed " << e.what() << std::endl;
+            }
+        }
+        if (user_in == "sspgo" || user_in == "sspgo binary")
+        {
+            if (model == nullptr)
+                std::cout << "no model" << std::endl;
+            else
+                StochasticSelfPlay(model, c_puct, dir_alpha, temp_cutoff, playouts, rng, user_in == "sspgo binary");
+        }
         if (user_in == "exit")
+        {
+            gsl_rng_free(rng);
             return -1;
+        }
     }
     return -1;
 }
 
-void StochasticSelfPlay(Model* network, float c_puct, float dir_alpha, int temp_cutoff, std::uint64_t playouts, gsl_rng* rng)
+void StochasticSelfPlay(Model* network, float c_puct, float dir_alpha, int temp_cutoff, std::uint64_t playouts, gsl_rng* rng, bool binary)
 {
+    // the whole game, for binary output
+    std::vector<unsigned char> moves;
+    std::vector<float> visits;
+
     // prepare dirichlet
     double alpha[7];
     double theta[7];  // where the return values of the dirichlet function go
@@ -141,7 +183,11 @@ void StochasticSelfPlay(Model* network, float c_puct, float dir_alpha, int temp_
         }
 
         // logging
-        if (true)
+        if (binary)
+        {
+            visits.insert(visits.end(), probs, probs + 7);
+        }
+        else
         {
             for (int i = 0; i < 7; i++)
             {
@@ -160,10 +206,29 @@ void StochasticSelfPlay(Model* network, float c_puct, float dir_alpha, int temp_
                 board.PlayMove(i);
                 eng.RecycleTree(i);
                 move_n++;
-                std::cout << '~' << i << std::endl;
+                if (binary)
+                    moves.push_back((unsigned char)i);
+                else
+                    std::cout << '~' << i << std::endl;
                 break;
             }
         }
     }
+    if (binary)
+    {
+        // header line, then the moves as bytes and the search probabilities
+        // as 7 float32 per move, then the usual done line
+        std::cout << "game " << moves.size() << ' ' << board.GameOver() << std::endl;
+#ifdef _WIN32
+        // stop \n bytes of the payload being written as \r\n
+        _setmode(_fileno(stdout), _O_BINARY);
+#endif
+        std::cout.write(reinterpret_cast<const char*>(moves.data()), moves.size());
+        std::cout.write(reinterpret_cast<const char*>(visits.data()), visits.size() * sizeof(float));
+        std::cout.flush();
+#ifdef _WIN32
+        _setmode(_fileno(stdout), _O_TEXT);
+#endif
+    }
     std::cout << "done" << std::endl;
 }
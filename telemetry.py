@@ -0,0 +1,143 @@
+"""
+Per-cycle telemetry of the training loop: the time spent in each stage,
+counters such as games played and samples trained, the rates they give,
+the buffer size and the process memory. Each cycle is appended to a JSON
+lines file and, given a writer, added to TensorBoard as scalars.
+`CountingNetwork` counts the network evaluations made through it.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+
+# counter -> the stage whose time it is a rate of
+RATES: Dict[str, str] = {
+    'games': 'selfplay',
+    'positions': 'selfplay',
+    'evals': 'selfplay',
+    'samples': 'fit',
+}
+
+
+class CountingNetwork:
+    """
+    Wraps a network, counting its `predict` calls and evaluated positions
+    """
+
+    def __init__(self, network) -> None:
+        self.network = network
+        self.calls = 0
+        self.positions = 0
+
+    def predict(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        self.calls += 1
+        self.positions += len(x)
+        return self.network.predict(x)
+
+
+def rss_bytes() -> int:
+    """
+    Returns
+    -------
+    rss: `int`
+        The resident memory of this process, None if it can not be read
+    """
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class CycleTelemetry:
+    """
+    Collects the timings and counters of one cycle at a time
+    """
+
+    def __init__(self, path: str, tf_writer=None) -> None:
+        """
+        Parameters
+        ----------
+        path: `str`
+            The JSON lines file, appended to
+        tf_writer: `tf.summary.FileWriter`
+            Defaults to None. Also write the scalars to TensorBoard
+        """
+        self.path = path
+        self.tf_writer = tf_writer
+        self.start_cycle(0)
+
+    def start_cycle(self, cycle: int) -> None:
+        self.cycle = cycle
+        self.started = time.perf_counter()
+        self.times: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Adds the time spent in the block to stage `name`
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def end_cycle(self, **gauges) -> dict:
+        """
+        Writes out the cycle
+        Parameters
+        ----------
+        gauges:
+            Values to record as they are, such as the buffer size
+        Returns
+        -------
+        record: `dict`
+            The cycle, its 'seconds', then 'time', 'count' and 'rate' per
+            second by stage or counter, 'rss_mb' and the gauges
+        """
+        rss = rss_bytes()
+        record = {
+            'cycle': self.cycle,
+            'seconds': time.perf_counter() - self.started,
+            'time': dict(self.times),
+            'count': dict(self.counts),
+            'rate': {name: self.counts[name] / self.times[stage]
+                     for name, stage in RATES.items()
+                     if self.counts.get(name) and self.times.get(stage)},
+            'rss_mb': rss / 2 ** 20 if rss is not None else None,
+        }
+        record.update(gauges)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        if self.tf_writer is not None:
+            summary = tf.Summary()
+            for group in ('time', 'count', 'rate'):
+                for key, value in record[group].items():
+                    summary.value.add(tag=f'{group}/{key}',
+                                      simple_value=value)
+            for key in ['seconds', 'rss_mb', *gauges]:
+                if record[key] is not None:
+                    summary.value.add(tag=f'cycle/{key}',
+                                      simple_value=record[key])
+            self.tf_writer.add_summary(summary, self.cycle)
+            self.tf_writer.flush()
+        return record
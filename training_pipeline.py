@@ -1,6 +1,6 @@
 import os
-import pickle
 import random
+import time
 from collections import deque
 from typing import List, Tuple
 
@@ -12,7 +12,11 @@ from keras.utils import to_categorical
 
 # import dnn
 import dnn
+from checkpoint import CheckpointWriter
+from distributed import Coordinator
+from replay_buffer import PrioritizedReplayBuffer, ReplayBuffer
 from selfplay import do_selfplay
+from telemetry import CountingNetwork, CycleTelemetry
 
 
 class TrainingPipeline:
@@ -28,7 +32,14 @@ class TrainingPipeline:
                  resume: bool = False, lr_mul: float = 1,
                  tb_active: bool = False, kl_tgt: float = 2e-3,
                  temp_cutoff: int = 32, minibatch_size: int = 256,
-                 n_sp: int = 1, mcts_batch_size: int = 10) -> None:
+                 n_sp: int = 1, mcts_batch_size: int = 10,
+                 prioritized: bool = False, per_alpha: float = 0.6,
+                 per_beta: float = 0.4, aggregate: bool = False,
+                 save_every: int = 1, save_seconds: float = None,
+                 keep_last: int = 5, milestone_every: int = 100,
+                 export_onnx: bool = False,
+                 coordinator: Coordinator = None,
+                 selfplay_backend: str = 'python') -> None:
         """
         Parameters
         ----------
@@ -74,6 +85,41 @@ class TrainingPipeline:
             Default 1. The amout of self-play games to play before each step
         mcts_batch_size: `int`
             Default 10. The level of parallisation in MCTS
+        prioritized: `bool`
+            Default False. Sample minibatches in proportion to each
+            position's last training loss, see `PrioritizedReplayBuffer`.
+            Only applies to a new buffer
+        per_alpha: `float`
+            Default 0.6. How strongly losses skew prioritized sampling
+        per_beta: `float`
+            Default 0.4. How much of the sampling bias the importance
+            sampling weights correct
+        aggregate: `bool`
+            Default False. Merge repeated positions, such as the opening,
+            into one buffer entry with the mean result and visits, trained
+            with the square root of the number of samples merged as its
+            weight. Only applies to a new buffer
+        save_every: `int`
+            Default 1. Checkpoint every this many cycles, 0 for never
+        save_seconds: `float`
+            Default None. Also checkpoint when this long has passed since the
+            last checkpoint
+        keep_last: `int`
+            Default 5. The number of latest checkpoints kept on disk
+        milestone_every: `int`
+            Default 100. Checkpoints of cycles divisible by this are kept for
+            good, 0 for none
+        export_onnx: `bool`
+            Default False. Export an ONNX model with every checkpoint
+        coordinator: `distributed.Coordinator`
+            Default None. Take selfplay games from the workers of this
+            coordinator, which are sent each new model, instead of playing
+            them here
+        selfplay_backend: `str`
+            Default 'python'. Play selfplay games with the python search of
+            selfplay.py ('python'), or with the native engines of
+            selfplay_v2.py ('engine'), which are given the model as ONNX and
+            so don't count their network evaluations in the telemetry
         """
         # safety checks
         if save_path:
@@ -81,6 +127,8 @@ class TrainingPipeline:
                 raise ValueError('There is an existing save.')
         if resume and not model:
             raise ValueError('No model to resume.')
+        if selfplay_backend not in ('python', 'engine'):
+            raise ValueError('Unknown selfplay backend.')
         # end safety checks
         self.save_path = (save_path if save_path else os.path.join(os.getcwd(),
                                                                    'tmp0'))
@@ -98,14 +146,32 @@ class TrainingPipeline:
         self.train_epochs = 5
         self.kl_tgt = kl_tgt  # 0.15 by default
         self.temp_cutoff = temp_cutoff
-        self.data_buffer = buffer if buffer else deque(maxlen=buffer_len)
+        self.coordinator = coordinator
+        self.selfplay_backend = selfplay_backend
+        if buffer:
+            self.data_buffer = buffer
+        elif prioritized:
+            self.data_buffer = PrioritizedReplayBuffer(buffer_len, per_alpha,
+                                                       per_beta,
+                                                       aggregate=aggregate)
+        elif aggregate:
+            self.data_buffer = ReplayBuffer(buffer_len, aggregate=True)
+        else:
+            self.data_buffer = deque(maxlen=buffer_len)
         self.model = (model if model else
                       dnn.create_model(history * 2 + 1))
+        # checkpoints are written in the background, see `CheckpointWriter`
+        self.checkpoints = CheckpointWriter(
+            self.model, self.save_path, save_every, save_seconds, keep_last,
+            milestone_every, export_onnx)
         if tb_active:
             self.tf_writer = tf.summary.FileWriter(os.path.join(
                 self.save_path, 'logs'), K.get_session().graph)
         else:
             self.tf_writer = None
+        # where the time of each cycle goes, see `CycleTelemetry`
+        self.telemetry = CycleTelemetry(
+            os.path.join(self.save_path, 'telemetry.jsonl'), self.tf_writer)
         print('Training Pipeline fueled and ready for liftoff!'
               '\nSummary:\n'
               f'Saving to: {self.save_path}\n'
@@ -164,22 +230,47 @@ class TrainingPipeline:
         -------
         `None`
         """
-        gen = do_selfplay(self.n_sp, self.playouts,
-                          self.c_puct, self.model,
-                          self.dir_alpha, self.temp_cutoff,
-                          self.mcts_batch_size)
-        for states, result, moves, mvisits in gen:  # this is next gen stuff
+        # only the python search evaluates through the model it is given,
+        # so only its evaluations can be counted
+        counted = (self.coordinator is None and
+                   self.selfplay_backend == 'python')
+        if self.coordinator is not None:
+            gen = self.coordinator.collect(self.n_sp)
+        elif counted:
+            network = CountingNetwork(self.model)
+            gen = do_selfplay(self.n_sp, self.playouts,
+                              self.c_puct, network,
+                              self.dir_alpha, self.temp_cutoff,
+                              self.mcts_batch_size)
+        else:
+            # imported here, as it needs the ONNX converter
+            import selfplay_v2
+            gen = selfplay_v2.do_selfplay(self.n_sp, self.playouts,
+                                          self.c_puct, self.model,
+                                          self.dir_alpha, self.temp_cutoff)
+        while True:  # this is next gen stuff
+            with self.telemetry.stage('selfplay'):
+                game = next(gen, None)
+            if game is None:
+                break
+            states, result, moves, mvisits = game
+            self.telemetry.count('games')
+            self.telemetry.count('positions', len(states))
             # result will be 1 if won by connecting 4, else it was a draw
-            data = []
-            for state, move, _mvisits in zip(states[::-1], moves[::-1],
-                                             mvisits[::-1]):
-                data.append((state, result, to_categorical([move],
-                                                           num_classes=7)[0],
-                             _mvisits * self.playouts / (self.playouts - 1)))
-                # (above), multiply by scalar because
-                # one playout is spent on expanding the root node
-                result *= -1
-            self.ext_equivalent_data(data)
+            with self.telemetry.stage('features'):
+                data = []
+                for state, move, _mvisits in zip(states[::-1], moves[::-1],
+                                                 mvisits[::-1]):
+                    data.append((state, result,
+                                 to_categorical([move], num_classes=7)[0],
+                                 _mvisits * self.playouts /
+                                 (self.playouts - 1)))
+                    # (above), multiply by scalar because
+                    # one playout is spent on expanding the root node
+                    result *= -1
+                self.ext_equivalent_data(data)
+        if counted:
+            self.telemetry.count('evals', network.positions)
 
     def update_network(self, e: int = 0) -> None:
         """
@@ -192,27 +283,55 @@ class TrainingPipeline:
         -------
         `None`
         """
-        minibatch = random.sample(self.data_buffer, self.minibatch_size)
+        sample_start = time.perf_counter()
+        prioritized = isinstance(self.data_buffer, PrioritizedReplayBuffer)
+        sample_weight = None
+        if prioritized:
+            indices, minibatch, weights = self.data_buffer.sample(
+                self.minibatch_size)
+        elif isinstance(self.data_buffer, ReplayBuffer):
+            indices = random.sample(range(len(self.data_buffer)),
+                                    self.minibatch_size)
+            minibatch = [self.data_buffer[i] for i in indices]
+            weights = np.ones(self.minibatch_size)
+        else:
+            minibatch = random.sample(self.data_buffer, self.minibatch_size)
+        if isinstance(self.data_buffer, ReplayBuffer):
+            # merged positions count once per sample merged
+            weights = weights * self.data_buffer.sample_weights(indices)
+            sample_weight = [weights, weights]
         states = np.array([d[0] for d in minibatch])
         results = np.array([d[1] for d in minibatch])
         # ignore move made
         mvisits = np.array([d[3] for d in minibatch])
+        self.telemetry.add_time('sample', time.perf_counter() - sample_start)
         K.set_value(self.model.optimizer.lr,
                     self.learning_rate * self.lr_multiplier)
-        old_probs = self.model.predict(states)[1]
+        with self.telemetry.stage('predict'):
+            old_probs = self.model.predict(states)[1]
         for i in range(self.train_epochs):
             # callback only on first training epoch
             # hence tensorboard / history will be reflective
             # of a model's true performance, disregarding overfitting
-            if self.tf_writer and not i:
-                train_hist = self.model.fit(x=states, y=[results, mvisits],
-                                            batch_size=self.minibatch_size,
-                                            verbose=False)
-            else:
-                self.model.fit(x=states, y=[results, mvisits],
-                               batch_size=self.minibatch_size,
-                               verbose=False)
-            new_probs = self.model.predict(states)[1]
+            with self.telemetry.stage('fit'):
+                if self.tf_writer and not i:
+                    train_hist = self.model.fit(
+                        x=states, y=[results, mvisits],
+                        batch_size=self.minibatch_size,
+                        sample_weight=sample_weight, verbose=False)
+                else:
+                    self.model.fit(x=states, y=[results, mvisits],
+                                   batch_size=self.minibatch_size,
+                                   sample_weight=sample_weight,
+                                   verbose=False)
+            self.telemetry.count('samples', len(states))
+            with self.telemetry.stage('predict'):
+                new_values, new_probs = self.model.predict(states)
+            if prioritized:
+                # the same losses as the network's, per sample
+                losses = ((new_values[:, 0] - results) ** 2 -
+                          np.sum(mvisits * np.log(new_probs + 1e-10), axis=1))
+                self.data_buffer.update_priorities(indices, losses)
             kl = np.mean(np.sum(old_probs * (np.log(old_probs + 1e-10) -
                                              np.log(new_probs + 1e-10)),
                                 axis=1))
@@ -237,6 +356,16 @@ class TrainingPipeline:
             self.tf_writer.add_summary(summary, e)
             self.tf_writer.flush()
 
+    def publish(self) -> None:
+        """
+        Sends the current model and selfplay settings to the workers
+        """
+        with self.telemetry.stage('publish'):
+            self.coordinator.publish(
+                self.model, playouts=self.playouts, c_puct=self.c_puct,
+                dir_alpha=self.dir_alpha, temp_cutoff=self.temp_cutoff,
+                mcts_batch_size=self.mcts_batch_size)
+
     def run(self, start_cycle: int = 0) -> None:
         """
         Start running the training cycle
@@ -247,18 +376,26 @@ class TrainingPipeline:
             loaded from
         """
         cycle = start_cycle
-        while True:
-            cycle += 1
-            self.gen_sp_data()
-            print(f'INFO: cycle={cycle}, datapoints={len(self.data_buffer)}')
-            if len(self.data_buffer) >= self.minibatch_size * 2:
-                self.update_network(cycle)
-            if cycle % 1:
-                continue
-            self.model.save(os.path.join(self.save_path, f'save_{cycle}.ntwk'))
-            pickle.dump(self.data_buffer, open(os.path.join(self.save_path,
-                                                            'data_buffer.dbuf'
-                                                            ), 'wb'))
+        if self.coordinator is not None:
+            self.publish()
+        try:
+            while True:
+                cycle += 1
+                self.telemetry.start_cycle(cycle)
+                self.gen_sp_data()
+                print(f'INFO: cycle={cycle}, '
+                      f'datapoints={len(self.data_buffer)}')
+                if len(self.data_buffer) >= self.minibatch_size * 2:
+                    self.update_network(cycle)
+                    if self.coordinator is not None:
+                        self.publish()
+                with self.telemetry.stage('checkpoint'):
+                    self.checkpoints.maybe_save(cycle, self.data_buffer)
+                self.telemetry.end_cycle(buffer=len(self.data_buffer),
+                                         lr_mul=self.lr_multiplier)
+        finally:
+            # queued checkpoints are still written on the way out
+            self.checkpoints.close()
 
 
 def main() -> None:
@@ -276,6 +413,10 @@ def main() -> None:
                                 playouts=600, kl_tgt=1e-3, c_puct=3,
                                 buffer_len=100000, n_sp=10, minibatch_size=512,
                                 mcts_batch_size=10)
+    # for selfplay on other hosts, pass
+    # coordinator=Coordinator('0.0.0.0', token=SECRET) and start
+    # `python distributed.py worker TRAINER_HOST --token SECRET` on each
+    # of them
     pipeline.run(0)
     # if loading:
     # pipeline.run(XYZ)